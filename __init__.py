@@ -2,6 +2,7 @@
 # copyright notices and license terms.
 from trytond.pool import Pool
 from . import account
+from . import ir
 from . import statement
 from . import payment
 
@@ -9,13 +10,22 @@ from . import payment
 def register():
     Pool.register(
         account.MoveLine,
+        account.MoveReconciliation,
+        ir.Cron,
         payment.Journal,
         payment.Group,
         payment.Payment,
+        payment.PaymentUnmatched,
+        payment.PaymentUnmatchedContext,
+        payment.PaymentForecast,
+        payment.PaymentPrediction,
+        statement.PaymentWatermark,
         statement.AddPaymentStart,
+        statement.ImportPaymentReturnStart,
         statement.StatementLine,
         statement.StatementMoveLine,
         module='account_bank_statement_payment', type_='model')
     Pool.register(
         statement.AddPayment,
+        statement.ImportPaymentReturn,
         module='account_bank_statement_payment', type_='wizard')
@@ -3,12 +3,12 @@
 from sql import Column
 from sql.aggregate import Max
 
-from trytond.model import fields
+from trytond.model import Index, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 
-__all__ = ['MoveLine']
+__all__ = ['MoveLine', 'MoveReconciliation']
 
 
 class MoveLine(metaclass=PoolMeta):
@@ -44,3 +44,55 @@ class MoveLine(metaclass=PoolMeta):
     @classmethod
     def search_payment_date(cls, name, clause):
         return [('payments.date',) + tuple(clause[1:])]
+
+
+class MoveReconciliation(metaclass=PoolMeta):
+    __name__ = 'account.move.reconciliation'
+    bank_statement_move_line = fields.Many2One(
+        'account.bank.statement.move.line', 'Bank Statement Move Line',
+        readonly=True, ondelete='SET NULL',
+        help='The bank statement move line whose posting made the '
+        'reconciliation.')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.bank_statement_move_line, Index.Range())))
+
+    @classmethod
+    def _payment_groups_to_update(cls, reconciliations):
+        pool = Pool()
+        Payment = pool.get('account.payment')
+
+        lines = [l for r in reconciliations for l in r.lines]
+        groups = set()
+        for sub_lines in grouped_slice(lines):
+            payments = Payment.search([
+                    ('line', 'in', [l.id for l in sub_lines]),
+                    ('group', '!=', None),
+                    ], order=[])
+            groups.update(p.group for p in payments)
+        return list(groups)
+
+    @classmethod
+    def on_modification(cls, mode, reconciliations, field_names=None):
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        super().on_modification(
+            mode, reconciliations, field_names=field_names)
+        if mode in {'create', 'write'}:
+            groups = cls._payment_groups_to_update(reconciliations)
+            if groups:
+                Group.update_settled(groups)
+
+    @classmethod
+    def on_delete(cls, reconciliations):
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        callback = super().on_delete(reconciliations)
+        groups = cls._payment_groups_to_update(reconciliations)
+        if groups:
+            callback.append(lambda: Group.update_settled(Group.browse(groups)))
+        return callback
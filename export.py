@@ -0,0 +1,147 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Export the links between bank statement lines, statement move lines,
+payments, groups, clearing moves and reconciliations of a fiscal year.
+
+The rows are read from the database in fixed-size batches following the
+order of their keys, so the memory used does not depend on the number of
+links on any backend. The command is bin/trytond-bank-statement-payment-export.
+"""
+import csv
+import datetime
+import json
+import time
+from decimal import Decimal
+
+__all__ = ['COLUMNS', 'write_links', 'export_links']
+
+COLUMNS = ['statement', 'statement_line', 'date', 'statement_move_line',
+    'amount', 'move', 'payment', 'group', 'clearing_move', 'payment_line',
+    'reconciliation']
+
+
+def _get_queries(fiscalyear):
+    """
+    Yield the queries of the links of the statement lines of fiscalyear with
+    the columns and the row indexes of their order keys
+    """
+    from sql import Null
+    from trytond.pool import Pool
+
+    pool = Pool()
+    StatementLine = pool.get('account.bank.statement.line')
+    StatementMoveLine = pool.get('account.bank.statement.move.line')
+    Payment = pool.get('account.payment')
+    Line = pool.get('account.move.line')
+    st_line = StatementLine.__table__()
+    move_line = StatementMoveLine.__table__()
+    payment = Payment.__table__()
+    line = Line.__table__()
+
+    start = datetime.datetime.combine(
+        fiscalyear.start_date, datetime.time.min)
+    end = datetime.datetime.combine(fiscalyear.end_date, datetime.time.max)
+    in_fiscalyear = ((st_line.company == fiscalyear.company.id)
+        & (st_line.date >= start) & (st_line.date <= end))
+
+    # Through the statement move lines with a payment
+    yield ((st_line
+        .join(move_line, condition=move_line.line == st_line.id)
+        .join(payment, condition=move_line.payment == payment.id)
+        .join(line, 'LEFT', condition=payment.line == line.id)
+        .select(st_line.statement, st_line.id, st_line.date,
+            move_line.id, move_line.amount, move_line.move,
+            payment.id, payment.group, payment.clearing_move,
+            payment.line, line.reconciliation,
+            where=in_fiscalyear,
+            order_by=[st_line.id.asc, move_line.id.asc])),
+        (st_line.id, move_line.id), (1, 3))
+
+    # Through the payment lines set as counterpart
+    yield ((st_line
+        .join(line, condition=line.bank_statement_line_counterpart
+            == st_line.id)
+        .join(payment, condition=payment.line == line.id)
+        .select(st_line.statement, st_line.id, st_line.date,
+            Null, Null, line.move,
+            payment.id, payment.group, payment.clearing_move,
+            line.id, line.reconciliation,
+            where=in_fiscalyear,
+            order_by=[st_line.id.asc, line.id.asc, payment.id.asc])),
+        (st_line.id, line.id, payment.id), (1, 9, 6))
+
+
+def _after(keys, values):
+    "Return the condition of the rows ordered after the values of keys"
+    (key, *keys), (value, *values) = keys, values
+    condition = key > value
+    if keys:
+        condition |= (key == value) & _after(keys, values)
+    return condition
+
+
+def _iter_rows(query, keys, indexes, size):
+    """
+    Yield the rows of query by batches of size, each batch starting after
+    the keys of the last row read
+    """
+    from trytond.transaction import Transaction
+
+    cursor = Transaction().connection.cursor()
+    where = query.where
+    query.limit = size
+    while True:
+        cursor.execute(*query)
+        rows = cursor.fetchall()
+        yield from rows
+        if len(rows) < size:
+            break
+        query.where = where & _after(keys, [rows[-1][i] for i in indexes])
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def write_links(fiscalyear, output, format='csv', size=1000):
+    "Write the links of the fiscal year to output and return the row count"
+    if format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(COLUMNS)
+        write = writer.writerow
+    else:
+        def write(row):
+            output.write(json.dumps(dict(zip(COLUMNS, row)),
+                    default=_json_default))
+            output.write('\n')
+    count = 0
+    for query, keys, indexes in _get_queries(fiscalyear):
+        for row in _iter_rows(query, keys, indexes, size):
+            write(row)
+            count += 1
+    return count
+
+
+def export_links(database, fiscalyear_id, output, format='csv', size=1000):
+    """
+    Write the links of the fiscal year to the file output as CSV or JSON
+    Lines. Return the number of rows and the elapsed seconds.
+    """
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(database)
+    pool.init()
+
+    start = time.perf_counter()
+    with Transaction().start(database, 0, readonly=True):
+        FiscalYear = pool.get('account.fiscalyear')
+        count = write_links(FiscalYear(fiscalyear_id), output,
+            format=format, size=size)
+    return count, time.perf_counter() - start
@@ -0,0 +1,21 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+__all__ = ['Cron']
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('account.payment.forecast|rebuild',
+                    "Rebuild Payment Forecast"),
+                ('account.payment.prediction|rebuild',
+                    "Rebuild Payment Predictions"),
+                ('account.bank.statement.line|cron_reconcile_payments',
+                    "Reconcile Bank Statement Payments"),
+                ])
@@ -1,14 +1,30 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
+import math
 from collections import defaultdict
 from decimal import Decimal
-from sql.aggregate import Sum
+from sql import Literal, Null, Values
+from sql.aggregate import Avg, Max, Min, Sum
+from sql.functions import Abs, Extract
+from sql.conditionals import Case, Coalesce
+from sql.operators import Exists
 
-from trytond.model import ModelView, Workflow, fields
+from trytond.config import config
+from trytond.model import (
+    Index, ModelSQL, ModelView, Unique, Workflow, fields)
+from trytond.modules.currency.fields import Monetary
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction, without_check_access
 
-__all__ = ['Journal', 'Group', 'Payment']
+from .tools import clear_cache
+
+__all__ = ['Journal', 'Group', 'Payment', 'PaymentUnmatched',
+    'PaymentUnmatchedContext', 'PaymentForecast', 'PaymentPrediction']
+
+_ZERO = Decimal(0)
 
 
 class Journal(metaclass=PoolMeta):
@@ -32,6 +48,81 @@ class Journal(metaclass=PoolMeta):
     advance = fields.Boolean('Advance',
         help='The Bank only advances the Due amount and it recover it at due '
         'date, indepently if the customer pays you.')
+    statement_window = fields.Integer('Statement Window',
+        domain=[
+            ['OR',
+                ('statement_window', '=', None),
+                ('statement_window', '>=', 0),
+                ],
+            ],
+        help='Only match payments dated within this number of days around '
+        'the date of the statement line.\n'
+        'Leave empty for no limit.')
+    statement_window_auto = fields.Boolean('Adaptive Window',
+        states={
+            'invisible': Eval('statement_window', None) == None,
+            },
+        help='Widen the window up to the longest settlement delay of the '
+        'journal.')
+    settlement_delay_average = fields.Function(fields.Numeric(
+            'Average Settlement Delay', digits=(16, 1),
+            help='The average number of days between the date of the '
+            'payments and the date of the statement lines that settled them.'),
+        'get_settlement_delays')
+    settlement_delay_max = fields.Function(fields.Numeric(
+            'Maximum Settlement Delay', digits=(16, 1),
+            help='The maximum number of days between the date of the '
+            'payments and the date of the statement lines that settled them.'),
+        'get_settlement_delays')
+    statement_cross_currency = fields.Boolean('Match Other Currencies',
+        help='Match the payment groups of this journal with bank statements '
+        'in another currency, converting their total at the date of the '
+        'statement line.')
+    statement_currency_tolerance = fields.Numeric('Currency Tolerance',
+        digits=(16, 4), domain=[
+            ['OR',
+                ('statement_currency_tolerance', '=', None),
+                ('statement_currency_tolerance', '>=', 0),
+                ],
+            ],
+        states={
+            'invisible': ~Eval('statement_cross_currency', False),
+            },
+        help='The maximum difference, in the currency of the statement, '
+        'between the converted total of a group and the statement line.')
+    statement_tolerance_amount = fields.Numeric('Amount Tolerance',
+        digits=(16, 4), domain=[
+            ['OR',
+                ('statement_tolerance_amount', '=', None),
+                ('statement_tolerance_amount', '>=', 0),
+                ],
+            ],
+        help='Match the payment groups with a total that differs from the '
+        'statement line by up to this amount.')
+    statement_tolerance_percent = fields.Numeric('Percent Tolerance',
+        digits=(16, 4), domain=[
+            ['OR',
+                ('statement_tolerance_percent', '=', None),
+                [
+                    ('statement_tolerance_percent', '>=', 0),
+                    ('statement_tolerance_percent', '<', 1),
+                    ],
+                ],
+            ],
+        help='Match the payment groups with a total that differs from the '
+        'statement line by up to this percentage of the total.')
+    statement_fee_account = fields.Many2One('account.account', 'Fee Account',
+        domain=[
+            ('company', '=', Eval('company', -1)),
+            ('type', '!=', None),
+            ('closed', '!=', True),
+            ],
+        states={
+            'invisible': (~Eval('statement_tolerance_amount')
+                & ~Eval('statement_tolerance_percent')),
+            },
+        help='The account of the difference with the statement line when a '
+        'group is matched within the tolerance.')
 
     @classmethod
     def __setup__(cls):
@@ -47,11 +138,128 @@ class Journal(metaclass=PoolMeta):
             return Decimal(1)
         return self.clearing_percent
 
+    @classmethod
+    def get_settlement_delays(cls, journals, names):
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        StatementLine = pool.get('account.bank.statement.line')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        payment = Payment.__table__()
+        line = StatementLine.__table__()
+        move_line = StatementMoveLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {n: {j.id: None for j in journals} for n in names}
+        delay = (Extract('EPOCH', line.date)
+            - Extract('EPOCH', payment.date)) / 86400
+        for sub_journals in grouped_slice(journals):
+            cursor.execute(*move_line
+                .join(payment, condition=move_line.payment == payment.id)
+                .join(line, condition=move_line.line == line.id)
+                .select(payment.journal, Avg(delay), Max(delay),
+                    where=reduce_ids(payment.journal,
+                        [j.id for j in sub_journals]),
+                    group_by=payment.journal))
+            for journal_id, average, maximum in cursor:
+                values = {
+                    'settlement_delay_average': average,
+                    'settlement_delay_max': maximum,
+                    }
+                for name in names:
+                    if values[name] is not None:
+                        result[name][journal_id] = Decimal(
+                            str(values[name])).quantize(Decimal('0.1'))
+        return result
+
+    def get_statement_window(self):
+        "Return the number of days of the window used to match statements"
+        window = self.statement_window
+        if (window is not None and self.statement_window_auto
+                and self.settlement_delay_max is not None):
+            window = max(window, int(math.ceil(self.settlement_delay_max)))
+        return window
+
+    @staticmethod
+    def default_statement_currency_tolerance():
+        return Decimal(0)
+
+    def get_statement_tolerance(self, total):
+        "Return the maximum difference allowed with the total of a group"
+        return max(self.statement_tolerance_amount or _ZERO,
+            abs(total) * (self.statement_tolerance_percent or _ZERO))
+
 
 class Group(metaclass=PoolMeta):
     __name__ = 'account.payment.group'
     total_amount = fields.Function(fields.Numeric('Total Amount'),
         'get_total_amount', searcher='search_total_amount')
+    settled = fields.Boolean('Settled', readonly=True,
+        help='All the payments of the group have a reconciled line.')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.id, Index.Range()), where=t.settled == Literal(False)))
+
+    @classmethod
+    def __register__(cls, module):
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        table_h = cls.__table_handler__(module)
+        settled_exists = table_h.column_exist('settled')
+
+        super().__register__(module)
+
+        if not settled_exists:
+            cursor.execute(*table.update([table.settled], [False]))
+            cursor.execute(*table.update([table.settled], [True],
+                    where=table.id.in_(cls._settled_query())))
+
+    @staticmethod
+    def default_settled():
+        return False
+
+    @classmethod
+    def _settled_query(cls, where=None):
+        "Return the query of the ids of groups with only reconciled payments"
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Line = pool.get('account.move.line')
+        payment = Payment.__table__()
+        line = Line.__table__()
+
+        condition = payment.state != 'failed'
+        if where is not None:
+            condition &= where(payment)
+        reconciled = Case((line.reconciliation != Null, 1), else_=0)
+        return payment.join(line, 'LEFT', condition=payment.line == line.id
+            ).select(payment.group,
+                where=condition & (payment.group != Null),
+                group_by=payment.group,
+                having=Min(reconciled) == 1)
+
+    @classmethod
+    @without_check_access
+    def update_settled(cls, groups):
+        "Set the settled flag of the groups from their payment lines"
+        cursor = Transaction().connection.cursor()
+
+        settled = set()
+        for sub_groups in grouped_slice(groups):
+            sub_ids = [g.id for g in sub_groups]
+            cursor.execute(*cls._settled_query(
+                    where=lambda p: reduce_ids(p.group, sub_ids)))
+            settled.update(r for r, in cursor)
+        to_write = []
+        for value in [True, False]:
+            records = [g for g in groups
+                if (g.id in settled) == value and g.settled != value]
+            if records:
+                to_write.extend((records, {'settled': value}))
+        if to_write:
+            cls.write(*to_write)
 
     def get_total_amount(self, name=None):
         amount = Decimal(0)
@@ -77,6 +285,161 @@ class Group(metaclass=PoolMeta):
 
 class Payment(metaclass=PoolMeta):
     __name__ = 'account.payment'
+    statement_closeness = fields.Function(fields.Numeric(
+            'Statement Closeness',
+            help='The difference with the amount of the statement lines.'),
+        'get_statement_closeness')
+    pending_amount = Monetary('Pending Amount', currency='currency',
+        digits='currency', readonly=True,
+        help='The amount not yet settled by posted bank statement lines.')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                # Used to match payment groups within a date window
+                Index(t, (t.group, Index.Range()), (t.date, Index.Range())),
+                Index(t, (t.pending_amount, Index.Range()),
+                    where=t.state.in_(['processing', 'succeeded'])),
+                })
+
+    @classmethod
+    def on_modification(cls, mode, payments, field_names=None):
+        pool = Pool()
+        Forecast = pool.get('account.payment.forecast')
+        super().on_modification(mode, payments, field_names=field_names)
+        if mode == 'create' or (
+                mode == 'write' and 'amount' in field_names):
+            cls.update_pending_amount(payments)
+        elif mode == 'write' and not {
+                    'state', 'date', 'journal', 'line', 'party',
+                    }.isdisjoint(field_names):
+            Forecast.update_payments(payments)
+
+    @classmethod
+    def update_pending_amount(cls, payments):
+        "Update the amount of payments not settled by statement lines"
+        pool = Pool()
+        Forecast = pool.get('account.payment.forecast')
+        for sub_payments in grouped_slice(payments):
+            cls._update_pending_amount([p.id for p in sub_payments])
+        clear_cache(payments)
+        Forecast.update_payments(payments)
+
+    @classmethod
+    def _update_pending_amount(cls, ids):
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Journal = pool.get('account.payment.journal')
+        StatementLine = pool.get('account.bank.statement.line')
+        Statement = pool.get('account.bank.statement')
+        StatementJournal = pool.get('account.bank.statement.journal')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        table = cls.__table__()
+        journal = Journal.__table__()
+        line = StatementLine.__table__()
+        statement = Statement.__table__()
+        statement_journal = StatementJournal.__table__()
+        move_line = StatementMoveLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # The payments without posted lines are not settled
+        cursor.execute(*table.update([table.pending_amount], [table.amount],
+                where=reduce_ids(table.id, ids)))
+
+        cursor.execute(*move_line
+            .join(line, condition=move_line.line == line.id)
+            .join(statement, condition=line.statement == statement.id)
+            .join(statement_journal,
+                condition=statement.journal == statement_journal.id)
+            .join(table, condition=move_line.payment == table.id)
+            .join(journal, condition=table.journal == journal.id)
+            .select(table.id, table.amount, table.kind, journal.currency,
+                statement_journal.currency, move_line.amount,
+                move_line.date,
+                where=reduce_ids(table.id, ids)
+                & (line.state == 'posted')))
+        currencies = {}
+        payments = {}
+        settled = defaultdict(Decimal)
+        for (payment_id, amount, kind, currency_id, statement_currency_id,
+                line_amount, date) in cursor:
+            if currency_id not in currencies:
+                currencies[currency_id] = Currency(currency_id)
+            currency = currencies[currency_id]
+            if statement_currency_id != currency_id:
+                with Transaction().set_context(date=date):
+                    line_amount = Currency.compute(
+                        Currency(statement_currency_id), line_amount,
+                        currency)
+            settled[payment_id] += line_amount
+            payments[payment_id] = (amount, kind, currency)
+
+        pending_ids = defaultdict(list)
+        for payment_id, (amount, kind, currency) in payments.items():
+            # The lines are signed from the point of view of the bank so the
+            # returns restore the pending amount up to the payment amount
+            sign = -1 if kind == 'payable' else 1
+            pending = currency.round(amount - sign * settled[payment_id])
+            pending = min(max(pending, _ZERO), amount)
+            pending_ids[pending].append(payment_id)
+        for pending, payment_ids in pending_ids.items():
+            for sub_ids in grouped_slice(payment_ids):
+                cursor.execute(*table.update(
+                        [table.pending_amount], [pending],
+                        where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def _get_statement_context(cls):
+        """
+        Return the list of the pending amount, date and party of each
+        statement line in context
+        """
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+        result = []
+        for line in StatementLine.browse(
+                Transaction().context.get('bank_statement_lines') or []):
+            party = getattr(line, 'party', None)
+            result.append((abs(line.company_amount - line.moves_amount),
+                    line.date.date(), party.id if party else None))
+        return result
+
+    @classmethod
+    def get_statement_closeness(cls, payments, name):
+        amounts = [a for a, _, _ in cls._get_statement_context()]
+        if not amounts:
+            return {p.id: None for p in payments}
+        result = {}
+        for payment in payments:
+            pending_amount = payment.pending_amount
+            if pending_amount is None:
+                pending_amount = payment.amount
+            result[payment.id] = min(abs(pending_amount - a) for a in amounts)
+        return result
+
+    @classmethod
+    def order_statement_closeness(cls, tables):
+        "Order by the closest statement line in context for each criteria"
+        table, _ = tables[None]
+        lines = cls._get_statement_context()
+        if not lines:
+            return []
+        order = []
+        parties = list({p for _, _, p in lines if p is not None})
+        if parties:
+            order.append(Case((table.party.in_(parties), 0), else_=1))
+        # The sub-queries are wrapped as order_by only accepts expressions
+        amounts = Values([[a] for a, _, _ in lines])
+        order.append(Coalesce(amounts.select(
+                    Min(Abs(Coalesce(table.pending_amount, table.amount)
+                            - amounts.column1))), 0))
+        dates = Values([[d] for _, d, _ in lines])
+        order.append(Coalesce(dates.select(
+                    Min(Abs(Extract('EPOCH', table.date)
+                            - Extract('EPOCH', dates.column1)))), 0))
+        return order
 
     @classmethod
     @ModelView.button
@@ -112,15 +475,511 @@ class Payment(metaclass=PoolMeta):
                         if not sum((l.debit - l.credit) for l in lines):
                             Line.reconcile(lines)
 
+    @classmethod
+    def transition_from_statement(cls, transitions):
+        """
+        Apply the transitions requested by the posting of statement lines
+
+        transitions is a dictionary of target state and payments which are
+        processed in chunks. The workflow ignores the payments already in the
+        target state, so running it again after a failure does not reprocess
+        them.
+        """
+        for state in ['failed', 'succeeded']:
+            payments = transitions.get(state)
+            if not payments:
+                continue
+            ids = list(dict.fromkeys(p.id for p in payments))
+            context = {}
+            if state == 'failed':
+                context['from_account_bank_statement_line'] = True
+            with Transaction().set_context(context):
+                for sub_ids in grouped_slice(ids):
+                    sub_payments = cls.browse(sub_ids)
+                    if state == 'failed':
+                        cls.fail(sub_payments)
+                    else:
+                        cls.succeed(sub_payments)
+
     def _get_clearing_move(self, date=None):
         if self.journal.advance:
             # it doesn't create clearing because it's done when bank recover it
             return
         move = super(Payment, self)._get_clearing_move(date=date)
-        if move and self.journal.clearing_percent < Decimal(1):
-            for line in move.lines:
-                line.debit *= self.journal.clearing_percent
-                line.debit = self.journal.currency.round(line.debit)
-                line.credit *= self.journal.clearing_percent
-                line.credit = self.journal.currency.round(line.credit)
+        if (move and not self.clearing_move
+                and self.journal.clearing_percent < Decimal(1)):
+            self._scale_clearing_move(move)
         return move
+
+    def _scale_clearing_move(self, move):
+        "Scale the lines of move by the clearing percent of the journal"
+        percent = self.journal.clearing_percent
+        currency = self.company.currency
+        second_currency = self.journal.currency
+        debit = credit = _ZERO
+        for line in move.lines:
+            line.debit = currency.round(line.debit * percent)
+            line.credit = currency.round(line.credit * percent)
+            if getattr(line, 'amount_second_currency', None):
+                line.amount_second_currency = second_currency.round(
+                    line.amount_second_currency * percent)
+            debit += line.debit
+            credit += line.credit
+        # Rounding each line may unbalance moves with more than two lines
+        drift = debit - credit
+        if drift:
+            if drift > _ZERO:
+                line = max(move.lines, key=lambda l: l.debit)
+                line.debit -= drift
+            else:
+                line = max(move.lines, key=lambda l: l.credit)
+                line.credit += drift
+
+
+class PaymentUnmatched(ModelSQL, ModelView):
+    'Unmatched Payment'
+    __name__ = 'account.payment.unmatched'
+    company = fields.Many2One('company.company', 'Company')
+    payment = fields.Many2One('account.payment', 'Payment')
+    journal = fields.Many2One('account.payment.journal', 'Journal')
+    group = fields.Many2One('account.payment.group', 'Group')
+    party = fields.Many2One('party.party', 'Party')
+    kind = fields.Selection([
+            ('payable', 'Payable'),
+            ('receivable', 'Receivable'),
+            ], 'Kind')
+    date = fields.Date('Date')
+    currency = fields.Many2One('currency.currency', 'Currency')
+    amount = Monetary('Amount', currency='currency',
+        digits='currency')
+    advanced_amount = Monetary('Advanced Amount', currency='currency',
+        digits='currency',
+        help='The part of the amount moved to the clearing account.')
+    pending_amount = Monetary('Pending Amount', currency='currency',
+        digits='currency',
+        help='The part of the amount the bank has not advanced.')
+    aging = fields.Selection([
+            ('0-30', '0-30 Days'),
+            ('31-60', '31-60 Days'),
+            ('61-90', '61-90 Days'),
+            ('90+', 'More than 90 Days'),
+            ], 'Aging')
+    age = fields.Function(fields.Integer('Age'), 'get_age')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('date', 'ASC'))
+
+    @classmethod
+    def _get_reference_date(cls):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        return Transaction().context.get('date') or Date.today()
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Journal = pool.get('account.payment.journal')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        payment = Payment.__table__()
+        journal = Journal.__table__()
+        move_line = StatementMoveLine.__table__()
+        context = Transaction().context
+
+        today = cls._get_reference_date()
+        aging = Case(
+            (payment.date >= today - datetime.timedelta(days=30), '0-30'),
+            (payment.date >= today - datetime.timedelta(days=60), '31-60'),
+            (payment.date >= today - datetime.timedelta(days=90), '61-90'),
+            else_='90+')
+        # Only the journals with a clearing account get an advance
+        advanced_amount = Case((journal.clearing_account != Null,
+                payment.amount * Coalesce(
+                    journal.clearing_percent, Decimal(1))),
+            else_=Decimal(0))
+
+        where = ((payment.state == 'processing')
+            & ~Exists(move_line.select(move_line.id,
+                    where=move_line.payment == payment.id)))
+        if context.get('company'):
+            where &= payment.company == context['company']
+        if context.get('journal'):
+            where &= payment.journal == context['journal']
+        if context.get('party'):
+            where &= payment.party == context['party']
+        if context.get('kind'):
+            where &= payment.kind == context['kind']
+        return payment.join(journal,
+            condition=payment.journal == journal.id
+            ).select(
+                payment.id.as_('id'),
+                payment.company.as_('company'),
+                payment.id.as_('payment'),
+                payment.journal.as_('journal'),
+                payment.group.as_('group'),
+                payment.party.as_('party'),
+                payment.kind.as_('kind'),
+                payment.date.as_('date'),
+                journal.currency.as_('currency'),
+                payment.amount.as_('amount'),
+                advanced_amount.as_('advanced_amount'),
+                (payment.amount - advanced_amount).as_('pending_amount'),
+                aging.as_('aging'),
+                where=where)
+
+    @classmethod
+    def get_age(cls, payments, name):
+        today = cls._get_reference_date()
+        return {p.id: (today - p.date).days if p.date else None
+            for p in payments}
+
+
+class PaymentUnmatchedContext(ModelView):
+    'Unmatched Payment Context'
+    __name__ = 'account.payment.unmatched.context'
+    company = fields.Many2One('company.company', 'Company', required=True)
+    date = fields.Date('Date', required=True,
+        help='The date used to compute the aging of the payments.')
+    journal = fields.Many2One('account.payment.journal', 'Journal',
+        domain=[
+            ('company', '=', Eval('company', -1)),
+            ])
+    party = fields.Many2One('party.party', 'Party',
+        context={
+            'company': Eval('company', -1),
+            })
+    kind = fields.Selection([
+            (None, ''),
+            ('payable', 'Payable'),
+            ('receivable', 'Receivable'),
+            ], 'Kind')
+
+    @classmethod
+    def default_company(cls):
+        return Transaction().context.get('company')
+
+    @classmethod
+    def default_date(cls):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        return Transaction().context.get('date') or Date.today()
+
+
+class PaymentForecast(ModelSQL, ModelView):
+    'Payment Forecast'
+    __name__ = 'account.payment.forecast'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    payment = fields.Many2One('account.payment', 'Payment', required=True,
+        readonly=True, ondelete='CASCADE')
+    journal = fields.Many2One('account.payment.journal', 'Journal',
+        required=True, readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True)
+    kind = fields.Selection([
+            ('payable', 'Payable'),
+            ('receivable', 'Receivable'),
+            ], 'Kind', readonly=True)
+    type = fields.Selection([
+            ('advanced', 'Advanced'),
+            ('pending', 'Pending'),
+            ('recovery', 'Recovery'),
+            ], 'Type', readonly=True,
+        help='"Advanced" is the part the bank moves at the payment date.\n'
+        '"Pending" is the rest, expected at the maturity date.\n'
+        '"Recovery" is the advance the bank takes back at the maturity date.')
+    date = fields.Date('Date', required=True, readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency',
+        required=True, readonly=True)
+    amount = Monetary('Amount', currency='currency', digits='currency',
+        required=True, readonly=True,
+        help='The expected bank movement, positive for incoming money.')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.company, Index.Range()), (t.date, Index.Range())),
+                Index(t, (t.payment, Index.Range())),
+                # Used by the statement matcher
+                Index(t, (t.company, Index.Range()),
+                    (t.amount, Index.Range())),
+                })
+        cls._order.insert(0, ('date', 'ASC'))
+
+    @classmethod
+    def _get_payments_query(cls, where=None):
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Journal = pool.get('account.payment.journal')
+        Line = pool.get('account.move.line')
+        payment = Payment.__table__()
+        journal = Journal.__table__()
+        line = Line.__table__()
+
+        condition = (payment.state == 'processing')
+        if where is not None:
+            condition &= where(payment)
+        return (payment
+            .join(journal, condition=payment.journal == journal.id)
+            .join(line, 'LEFT', condition=payment.line == line.id)
+            .select(payment.id, payment.company, payment.journal,
+                payment.party, payment.kind, payment.date, payment.amount,
+                Coalesce(payment.pending_amount, payment.amount),
+                journal.currency, journal.clearing_account,
+                journal.clearing_percent, journal.advance, line.maturity_date,
+                where=condition))
+
+    @classmethod
+    def _get_forecasts(cls, row):
+        "Return the values of the forecasts of the payment row"
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        (payment, company, journal, party, kind, date, amount, pending,
+            currency, clearing_account, percent, advance,
+            maturity_date) = row
+        currency = Currency(currency)
+        amount, pending = Decimal(amount), Decimal(pending)
+        sign = 1 if kind == 'receivable' else -1
+
+        if advance:
+            parts = [('advanced', date, amount),
+                ('recovery', maturity_date or date, -amount)]
+        else:
+            # Only the clearing account receives an advanced part
+            if not clearing_account or percent is None:
+                percent = 1
+            advanced = currency.round(amount * Decimal(percent))
+            parts = [('advanced', date, advanced),
+                ('pending', maturity_date or date, amount - advanced)]
+        # Remove what posted statement lines already settled
+        settled = amount - pending
+        values = []
+        for type_, date, part in parts:
+            if type_ != 'recovery':
+                consumed = min(settled, part)
+                settled -= consumed
+                part -= consumed
+            if part:
+                values.append({
+                        'company': company,
+                        'payment': payment,
+                        'journal': journal,
+                        'party': party,
+                        'kind': kind,
+                        'type': type_,
+                        'date': date,
+                        'currency': currency.id,
+                        'amount': sign * part,
+                        })
+        return values
+
+    @classmethod
+    @without_check_access
+    def update_payments(cls, payments):
+        "Recompute the forecasts of the payments"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_payments in grouped_slice(payments):
+            sub_ids = [p.id for p in sub_payments]
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.payment, sub_ids)))
+            cursor.execute(*cls._get_payments_query(
+                    where=lambda p: reduce_ids(p.id, sub_ids)))
+            to_create = []
+            for row in cursor.fetchall():
+                to_create.extend(cls._get_forecasts(row))
+            if to_create:
+                cls.create(to_create)
+
+    @classmethod
+    @without_check_access
+    def rebuild(cls):
+        "Recompute the forecasts of all the processing payments"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.delete())
+        cursor.execute(*cls._get_payments_query())
+        while True:
+            rows = cursor.fetchmany(Transaction().database.IN_MAX)
+            if not rows:
+                break
+            to_create = []
+            for row in rows:
+                to_create.extend(cls._get_forecasts(row))
+            if to_create:
+                cls.create(to_create)
+
+
+class PaymentPrediction(ModelSQL, ModelView):
+    'Payment Prediction'
+    __name__ = 'account.payment.prediction'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    party = fields.Many2One('party.party', 'Party', required=True,
+        readonly=True, ondelete='CASCADE')
+    journal = fields.Many2One('account.payment.journal', 'Journal',
+        required=True, readonly=True, ondelete='CASCADE')
+    kind = fields.Selection([
+            ('payable', 'Payable'),
+            ('receivable', 'Receivable'),
+            ], 'Kind', required=True, readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency',
+        required=True, readonly=True)
+    amount = Monetary('Amount', currency='currency', digits='currency',
+        required=True, readonly=True)
+    last_date = fields.Date('Last Date', required=True, readonly=True)
+    interval = fields.Integer('Interval', readonly=True,
+        help='The average number of days between the statement lines.')
+    count = fields.Integer('Count', required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('key_unique',
+                Unique(t, t.company, t.kind, t.amount, t.party, t.journal),
+                'account_bank_statement_payment.msg_prediction_key_unique'),
+            ]
+        cls._order.insert(0, ('last_date', 'DESC'))
+
+    @property
+    def next_date(self):
+        if self.interval:
+            return self.last_date + datetime.timedelta(days=self.interval)
+
+    @classmethod
+    def _get_move_lines_query(cls, where=None):
+        "Return the query of the posted statement move lines with a payment"
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        Payment = pool.get('account.payment')
+        Journal = pool.get('account.payment.journal')
+        line = StatementLine.__table__()
+        move_line = StatementMoveLine.__table__()
+        payment = Payment.__table__()
+        journal = Journal.__table__()
+
+        condition = ((line.state == 'posted')
+            & (move_line.date >= cls._get_history_start()))
+        if where is not None:
+            condition &= where(move_line)
+        return (move_line
+            .join(line, condition=move_line.line == line.id)
+            .join(payment, condition=move_line.payment == payment.id)
+            .join(journal, condition=payment.journal == journal.id)
+            .select(payment.company, payment.party, payment.journal,
+                payment.kind, journal.currency, Abs(move_line.amount),
+                move_line.date,
+                where=condition,
+                order_by=[move_line.date.asc, move_line.id.asc]))
+
+    @staticmethod
+    def _get_history_start():
+        "Return the date from which the statement move lines are kept"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        return Date.today() - datetime.timedelta(days=config.getint(
+                'account_bank_statement_payment', 'prediction_days',
+                default=400))
+
+    @classmethod
+    def _add_history(cls, predictions, rows):
+        """
+        Update the dictionary of predictions per key with the rows of
+        statement move lines
+        """
+        for (company, party, journal, kind, currency, amount, date) in rows:
+            if isinstance(date, str):
+                date = datetime.date.fromisoformat(date)
+            key = (company, kind, Decimal(str(amount)), party, journal)
+            prediction = predictions.get(key)
+            if not prediction:
+                predictions[key] = cls(company=company, party=party,
+                    journal=journal, kind=kind, currency=currency,
+                    amount=key[2], last_date=date, interval=None, count=1)
+                continue
+            days = (date - prediction.last_date).days
+            if days > 0:
+                gaps = prediction.count - 1
+                prediction.interval = int(round(
+                    ((prediction.interval or 0) * gaps + days) / (gaps + 1)))
+                prediction.last_date = date
+            prediction.count += 1
+
+    @classmethod
+    @without_check_access
+    def update_move_lines(cls, move_lines):
+        "Add the posted statement move lines to the history"
+        cursor = Transaction().connection.cursor()
+
+        rows = []
+        for sub_lines in grouped_slice(move_lines):
+            sub_ids = [l.id for l in sub_lines]
+            cursor.execute(*cls._get_move_lines_query(
+                    where=lambda m: reduce_ids(m.id, sub_ids)))
+            rows.extend(cursor)
+        if not rows:
+            return
+        rows.sort(key=lambda r: r[-1])
+        predictions = {}
+        for sub_parties in grouped_slice(list({r[1] for r in rows})):
+            for prediction in cls.search([
+                        ('party', 'in', list(sub_parties)),
+                        ]):
+                predictions[(prediction.company.id, prediction.kind,
+                        prediction.amount, prediction.party.id,
+                        prediction.journal.id)] = prediction
+        cls._add_history(predictions, rows)
+        cls.save(list(predictions.values()))
+        cls._purge()
+
+    @classmethod
+    def _purge(cls):
+        "Delete the predictions not seen within the history days"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.delete(
+                where=table.last_date < cls._get_history_start()))
+
+    @classmethod
+    @without_check_access
+    def rebuild(cls, parties=None):
+        """
+        Recompute the predictions of the parties, or all of them, from the
+        posted statement move lines
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        table = cls.__table__()
+        payment = Payment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if parties is None:
+            cursor.execute(*table.delete())
+            queries = [cls._get_move_lines_query()]
+        else:
+            queries = []
+            for sub_ids in grouped_slice(list({p.id for p in parties})):
+                sub_ids = list(sub_ids)
+                cursor.execute(*table.delete(
+                        where=reduce_ids(table.party, sub_ids)))
+                queries.append(cls._get_move_lines_query(
+                        where=lambda m: m.payment.in_(payment.select(
+                                payment.id,
+                                where=reduce_ids(payment.party, sub_ids)))))
+        predictions = {}
+        for query in queries:
+            cursor.execute(*query)
+            while True:
+                rows = cursor.fetchmany(Transaction().database.IN_MAX)
+                if not rows:
+                    break
+                cls._add_history(predictions, rows)
+        cls.save(list(predictions.values()))
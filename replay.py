@@ -0,0 +1,125 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Replay the payment reconciliation of a bank statement and profile it.
+
+Everything is run inside a transaction that is rolled back, so no data is
+changed. The command is bin/trytond-bank-statement-payment-replay.
+"""
+import cProfile
+import os
+import pstats
+import time
+
+__all__ = ['replay']
+
+MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+class _RecordingCursor(object):
+    "Cursor calling record with the duration and the query of each execute"
+
+    def __init__(self, cursor, record):
+        self._cursor = cursor
+        self._record = record
+
+    def _execute(self, method, query, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(query, *args, **kwargs)
+        finally:
+            self._record(time.perf_counter() - start, query)
+
+    def execute(self, query, *args, **kwargs):
+        return self._execute(self._cursor.execute, query, *args, **kwargs)
+
+    def executemany(self, query, *args, **kwargs):
+        return self._execute(
+            self._cursor.executemany, query, *args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _RecordingConnection(object):
+
+    def __init__(self, connection, record):
+        self._connection = connection
+        self._record = record
+
+    def cursor(self, *args, **kwargs):
+        return _RecordingCursor(
+            self._connection.cursor(*args, **kwargs), self._record)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def replay(database, statement_id, post=False, output='.', limit=20):
+    """
+    Run the payment reconciliation of the statement, and optionally the
+    posting of its lines, and write the profile and the SQL log to output.
+    Return the paths of the profile and of the SQL log.
+    """
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(database)
+    pool.init()
+
+    profile_path = os.path.join(output, 'statement-%s.prof' % statement_id)
+    log_path = os.path.join(output, 'statement-%s.sql.log' % statement_id)
+    queries = []
+    profiler = cProfile.Profile()
+
+    with Transaction().start(database, 0) as transaction:
+        Statement = pool.get('account.bank.statement')
+        StatementLine = pool.get('account.bank.statement.line')
+
+        statement = Statement(statement_id)
+        with transaction.set_context(company=statement.company.id):
+            lines = StatementLine.browse([l.id for l in statement.lines])
+            # Match all the lines as if it was the first time
+            StatementLine.write(lines, {'payment_match_fingerprint': None})
+
+            connection = transaction.connection
+            transaction.connection = _RecordingConnection(connection,
+                lambda duration, query: queries.append(
+                    (duration, str(query))))
+            profiler.enable()
+            try:
+                StatementLine.search_reconcile(lines)
+                if post:
+                    StatementLine.post(StatementLine.browse(
+                            [l.id for l in lines if l.state == 'confirmed']))
+            finally:
+                profiler.disable()
+                transaction.connection = connection
+        transaction.rollback()
+
+    profiler.dump_stats(profile_path)
+    with open(log_path, 'w') as log:
+        for duration, query in queries:
+            log.write('%.6f\t%s\n' % (duration, query.replace('\n', ' ')))
+
+    print('%s queries in %.3fs' % (
+            len(queries), sum(d for d, _ in queries)))
+    print('\nSlowest queries:')
+    for duration, query in sorted(queries, reverse=True)[:limit]:
+        print('%.6f\t%s' % (duration, query[:200]))
+
+    print('\nMost called functions of the module:')
+    stats = pstats.Stats(profiler)
+    functions = [(value[1], value[3], function)
+        for function, value in stats.stats.items()
+        if function[0].startswith(MODULE_PATH)]
+    for ncalls, cumtime, (filename, lineno, name) in sorted(
+            functions, reverse=True)[:limit]:
+        print('%8d %10.3fs  %s:%s(%s)' % (
+                ncalls, cumtime, os.path.relpath(filename, MODULE_PATH),
+                lineno, name))
+    return profile_path, log_path
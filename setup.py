@@ -110,6 +110,10 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         'Topic :: Office/Business',
         ],
     license='GPL-3',
+    scripts=[
+        'bin/trytond-bank-statement-payment-replay',
+        'bin/trytond-bank-statement-payment-export',
+        ],
     install_requires=requires,
     dependency_links=dependency_links,
     zip_safe=False,
@@ -1,97 +1,1647 @@
 # The COPYRIGHT file at  the top level of this repository contains the full
 # copyright notices and license terms.
+import bisect
+import csv
 import datetime
+import hashlib
+import io
+import logging
+import time
 from collections import defaultdict
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+from itertools import groupby
+from operator import itemgetter
+from sql import Literal, Null, Select
+from sql.aggregate import Max, Min, Sum
+from sql.operators import Exists
+from sql.conditionals import Case, Coalesce
+from sql.functions import (
+    Abs, CharLength, CurrentTimestamp, Extract, Position)
 
-from trytond.model import ModelView, fields
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, Unique, fields
+from trytond.modules.currency.fields import Monetary
 from trytond.pool import Pool, PoolMeta
 from trytond.wizard import Wizard, StateTransition, StateView, Button
 from trytond.pyson import Bool, Eval, If
 from trytond.transaction import Transaction
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 
-__all__ = ['StatementLine', 'StatementMoveLine', 'AddPaymentStart',
-    'AddPayment']
+from .tools import clear_cache
+
+__all__ = ['PaymentWatermark', 'StatementLine', 'StatementMoveLine',
+    'AddPaymentStart', 'AddPayment', 'ImportPaymentReturnStart',
+    'ImportPaymentReturn']
 
 _ZERO = Decimal(0)
 
+logger = logging.getLogger(__name__)
+
+
+class PaymentMatchingSession(object):
+    "State shared by the payment matching of a set of statement lines"
+
+    def __init__(self):
+        self.converted_totals = {}
+        self.group_amounts = {}
+        self.claimed_groups = set()
+        self.claimed_payments = set()
+        self.windows = {}
+        self.deadline = None
+
+
+class PaymentProposal(object):
+    "Proposal to match a payment with a statement line"
+    __slots__ = ('line', 'payment', 'group', 'account', 'amount', 'score',
+        'counterpart')
+
+    def __init__(self, line, payment, group=None, account=None, amount=None,
+            score=1.0, counterpart=None):
+        self.line = line
+        self.payment = payment
+        self.group = group
+        self.account = account
+        self.amount = amount
+        self.score = score
+        self.counterpart = counterpart
+
+    def to_dict(self):
+        return {
+            'line': self.line.id,
+            'payment': self.payment.id if self.payment else None,
+            'group': self.group.id if self.group else None,
+            'account': self.account.id if self.account else None,
+            'amount': self.amount,
+            'score': self.score,
+            'counterpart': self.counterpart.id if self.counterpart else None,
+            }
+
+    @classmethod
+    def from_dict(cls, values):
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+        Account = pool.get('account.account')
+        Line = pool.get('account.move.line')
+
+        def browse(Model, id_):
+            return Model(id_) if id_ is not None else None
+        return cls(StatementLine(values['line']),
+            browse(Payment, values.get('payment')),
+            group=browse(Group, values.get('group')),
+            account=browse(Account, values.get('account')),
+            amount=values.get('amount'),
+            score=values.get('score', 1.0),
+            counterpart=browse(Line, values.get('counterpart')))
+
+
+class PaymentWatermark(ModelSQL):
+    'Bank Statement Payment Watermark'
+    __name__ = 'account.bank.statement.payment.watermark'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    watermark = fields.Timestamp('Watermark',
+        help='The lines and payments changed before are already matched.')
+    run_start = fields.Timestamp('Run Start',
+        help='The start of the run not finished yet.')
+    last_line = fields.Integer('Last Line',
+        help='The last line processed by the run not finished yet.')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('company_unique', Unique(t, t.company),
+                'account_bank_statement_payment.msg_watermark_company_unique'),
+            ]
+
+    @classmethod
+    def get(cls, company_id):
+        """
+        Return the watermark of the company locked until the end of the
+        transaction or None if another transaction holds it
+        """
+        table = cls.__table__()
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+
+        marks = cls.search([('company', '=', company_id)], limit=1)
+        if not marks:
+            marks = cls.create([{'company': company_id}])
+        mark, = marks
+        if database.has_select_for():
+            For = database.get_select_for_skip_locked()
+            cursor.execute(*table.select(table.id,
+                    where=table.id == mark.id,
+                    for_=For('UPDATE')))
+            if not cursor.fetchone():
+                return
+        return mark
+
 
 class StatementLine(metaclass=PoolMeta):
     __name__ = 'account.bank.statement.line'
+    payment_match_fingerprint = fields.Char('Payment Match Fingerprint',
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(StatementLine, cls).__setup__()
+        cls.__rpc__.update({
+                'get_payment_proposals': RPC(instantiate=0),
+                'accept_payment_proposals': RPC(readonly=False),
+                })
+
+    @classmethod
+    def search_reconcile(cls, st_lines):
+        # Only lines whose data or candidates changed since their last
+        # matching are processed again
+        fingerprints = cls._get_payment_match_fingerprints(st_lines)
+        st_lines = [l for l in st_lines
+            if l.payment_match_fingerprint != fingerprints[l.id]]
+        if not st_lines:
+            return
+        # Share the matching state between all the lines
+        with Transaction().set_context(
+                _bank_statement_payment_session=PaymentMatchingSession()):
+            super(StatementLine, cls).search_reconcile(st_lines)
+
+        st_lines = cls.browse(st_lines)
+        fingerprints = cls._get_payment_match_fingerprints(st_lines)
+        to_update = defaultdict(list)
+        for line in st_lines:
+            fingerprint = fingerprints[line.id]
+            if line.payment_match_fingerprint != fingerprint:
+                to_update[fingerprint].append(line)
+        cls._set_payment_match_fingerprints(to_update)
+
+    @classmethod
+    def _set_payment_match_fingerprints(cls, fingerprints):
+        """
+        Store the dictionary of fingerprint and lines
+
+        It is stored through SQL so the write_date of the lines does not
+        select them again for the next run of the cron.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for fingerprint, lines in fingerprints.items():
+            for sub_lines in grouped_slice(lines):
+                cursor.execute(*table.update(
+                        [table.payment_match_fingerprint], [fingerprint],
+                        where=reduce_ids(table.id, [l.id for l in sub_lines])))
+            clear_cache(lines)
+
+    @classmethod
+    def _get_payment_match_fingerprints(cls, st_lines):
+        """
+        Return a dictionary with the fingerprint of the data used to match
+        each line: amount, date, party, description, amount of its moves,
+        the state of the payments already matched and the last change of the
+        candidate payments and groups of its kind.
+        """
+        pool = Pool()
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+        Line = pool.get('account.move.line')
+        move_line = StatementMoveLine.__table__()
+        payment = Payment.__table__()
+        group = Group.__table__()
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # Payments of other currencies are candidates of cross-currency
+        # groups so the change is per company and kind
+        changes = defaultdict(list)
+        company_ids = list({l.company.id for l in st_lines})
+        for table in [payment, group]:
+            cursor.execute(*table.select(table.company, table.kind,
+                    Max(Coalesce(table.write_date, table.create_date)),
+                    where=table.company.in_(company_ids),
+                    group_by=[table.company, table.kind]))
+            for company_id, kind, date in cursor:
+                changes[(company_id, kind)].append(str(date))
+
+        states = defaultdict(set)
+        ids = [l.id for l in st_lines]
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*move_line.join(payment,
+                    condition=move_line.payment == payment.id
+                    ).select(move_line.line, payment.id, payment.state,
+                    where=reduce_ids(move_line.line, sub_ids)))
+            for line_id, payment_id, state in cursor:
+                states[line_id].add((payment_id, state))
+            cursor.execute(*line.join(payment,
+                    condition=payment.line == line.id
+                    ).select(line.bank_statement_line_counterpart,
+                    payment.id, payment.state,
+                    where=reduce_ids(
+                        line.bank_statement_line_counterpart, sub_ids)))
+            for line_id, payment_id, state in cursor:
+                states[line_id].add((payment_id, state))
+
+        fingerprints = {}
+        for st_line in st_lines:
+            party = getattr(st_line, 'party', None)
+            kind = 'receivable' if st_line.amount > _ZERO else 'payable'
+            values = [
+                str(st_line.amount),
+                str(st_line.date),
+                str(party.id if party else None),
+                st_line.description or '',
+                str(st_line.moves_amount),
+                ] + ['%s:%s' % s for s in sorted(states[st_line.id])
+                ] + changes[(st_line.company.id, kind)]
+            fingerprints[st_line.id] = hashlib.sha1(
+                '\x1f'.join(values).encode('utf-8')).hexdigest()
+        return fingerprints
+
+    @classmethod
+    def cron_reconcile_payments(cls):
+        """
+        Match the payments of the statement lines changed since the last run
+        of each company, in one transaction per company and within the time
+        limit of the run
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+        transaction = Transaction()
+
+        deadline = time.monotonic() + config.getfloat(
+            'account_bank_statement_payment', 'cron_time_limit',
+            default=1800)
+        company_id = transaction.context.get('company')
+        if company_id is not None:
+            company_ids = [company_id]
+        else:
+            company_ids = [c.id for c in Company.search([])]
+        for company_id in company_ids:
+            if time.monotonic() > deadline:
+                break
+            try:
+                with transaction.new_transaction() as new_transaction, \
+                        new_transaction.set_context(company=company_id):
+                    cls._reconcile_payments_company(company_id, deadline)
+            except Exception:
+                # The other companies are still processed
+                logger.exception(
+                    "Fail to reconcile the payments of company %s",
+                    company_id)
+
+    @classmethod
+    def _reconcile_payments_company(cls, company_id, deadline):
+        """
+        Match the lines of the company changed since its watermark until
+        deadline. Return True if all the lines have been processed.
+        """
+        pool = Pool()
+        Watermark = pool.get('account.bank.statement.payment.watermark')
+        cursor = Transaction().connection.cursor()
+
+        mark = Watermark.get(company_id)
+        if not mark:
+            # Another transaction is processing the company
+            return False
+        if mark.run_start is None:
+            cursor.execute(*Select([CurrentTimestamp()]))
+            run_start, = cursor.fetchone()
+            if not isinstance(run_start, datetime.datetime):
+                run_start = datetime.datetime.fromisoformat(str(run_start))
+            mark.run_start = run_start
+            mark.last_line = None
+
+        domain = [
+            ('company', '=', company_id),
+            ('state', '=', 'confirmed'),
+            ]
+        if mark.watermark:
+            changed = ['OR',
+                ('create_date', '>=', mark.watermark),
+                ('write_date', '>=', mark.watermark),
+                ]
+            unmatched = cls._get_unmatched_lines_domain(
+                company_id, mark.watermark)
+            if unmatched:
+                # New candidates for the lines not fully matched
+                changed.append([
+                        ('payment_match_fingerprint', '=', None),
+                        unmatched,
+                        ])
+            domain.append(changed)
+        if mark.last_line:
+            domain.append(('id', '>', mark.last_line))
+        lines = cls.search(domain, order=[('id', 'ASC')])
+
+        finished = True
+        for sub_lines in grouped_slice(lines, config.getint(
+                    'account_bank_statement_payment', 'cron_batch_size',
+                    default=100)):
+            if time.monotonic() > deadline:
+                finished = False
+                break
+            sub_lines = list(sub_lines)
+            cls.search_reconcile(sub_lines)
+            mark.last_line = sub_lines[-1].id
+            mark.save()
+        if finished:
+            # Keep a margin for the transactions still running at start
+            mark.watermark = mark.run_start - datetime.timedelta(
+                seconds=config.getint(
+                    'account_bank_statement_payment', 'watermark_margin',
+                    default=300))
+            mark.run_start = None
+            mark.last_line = None
+        mark.save()
+        return finished
+
+    @classmethod
+    def _get_unmatched_lines_domain(cls, company_id, watermark):
+        """
+        Return the domain of the lines for which the payments of the company
+        changed since watermark may be candidates or None
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Journal = pool.get('account.payment.journal')
+        payment = Payment.__table__()
+        journal = Journal.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*payment.join(journal,
+                condition=payment.journal == journal.id
+                ).select(payment.kind, journal.statement_window,
+                journal.statement_window_auto,
+                Min(payment.date), Max(payment.date),
+                where=(payment.company == company_id)
+                & payment.state.in_(['processing', 'succeeded'])
+                & ((payment.create_date >= watermark)
+                    | (payment.write_date >= watermark)),
+                group_by=[payment.kind, journal.statement_window,
+                    journal.statement_window_auto]))
+        domain = ['OR']
+        for kind, window, auto, min_date, max_date in cursor:
+            clause = [('amount', '>' if kind == 'receivable' else '<', 0)]
+            if window is not None and not auto:
+                if isinstance(min_date, str):
+                    min_date = datetime.date.fromisoformat(min_date)
+                    max_date = datetime.date.fromisoformat(max_date)
+                delta = datetime.timedelta(days=window)
+                clause.append(('date', '>=', datetime.datetime.combine(
+                            min_date - delta, datetime.time.min)))
+                clause.append(('date', '<=', datetime.datetime.combine(
+                            max_date + delta, datetime.time.max)))
+            domain.append(clause)
+        if len(domain) > 1:
+            return domain
+
+    @staticmethod
+    def _get_payment_matching_session():
+        session = Transaction().context.get('_bank_statement_payment_session')
+        if session is None:
+            session = PaymentMatchingSession()
+        return session
 
     def _search_payments(self, amount):
         """
-        Return a list of payments from payment group with total equal to amount
+        Return the list of payments that best match amount
+        """
+        payments, _ = self._match_payments(amount)
+        return payments
+
+    @classmethod
+    def _payment_matching_strategies(cls):
+        """
+        Return the list of cost and name of the strategies to match payments
+
+        Each strategy is a method _match_payments_<name> which takes the
+        amount and the deadline, and returns the payments and the score of
+        the match or None. It may also return the amounts matched per
+        payment id if it matches only a part of the payments. Strategies run
+        from the cheapest.
+        """
+        return [
+            (5, 'prediction'),
+            (10, 'exact_group'),
+            (15, 'forecast'),
+            (20, 'converted_group'),
+            (30, 'reference'),
+            (40, 'party_amount'),
+            (50, 'tolerance'),
+            (100, 'subset'),
+            ]
+
+    @staticmethod
+    def _get_payment_match_confidence():
+        "Return the score from which a match is applied without review"
+        return config.getfloat(
+            'account_bank_statement_payment', 'confidence', default=0.8)
+
+    def _match_payments(self, amount, claim=False, details=None):
+        """
+        Return the payments and the score of the best match found by the
+        strategies within the time budget
+
+        The payments are reserved for the rest of the matching session. If
+        claim is set and the score reaches the confidence, they are also
+        locked until the end of the transaction. If details is a dictionary,
+        it is filled with the name of the strategy of the match as
+        'strategy', the amounts it matched per payment id as 'amounts' and
+        the accounts it matched per payment id as 'accounts'.
+        """
+        session = self._get_payment_matching_session()
+        now = time.monotonic()
+        if session.deadline is None:
+            session.deadline = now + config.getfloat(
+                'account_bank_statement_payment', 'statement_time_budget',
+                default=60)
+        deadline = min(session.deadline, now + config.getfloat(
+                'account_bank_statement_payment', 'line_time_budget',
+                default=2))
+        confidence = self._get_payment_match_confidence()
+
+        if abs(amount) == _ZERO:
+            return [], 0
+        while True:
+            best, strategy = ([], 0), None
+            for _, name in sorted(self._payment_matching_strategies()):
+                # The exact group match is cheap so it runs even out of time
+                if name != 'exact_group' and time.monotonic() > deadline:
+                    continue
+                match = getattr(self, '_match_payments_%s' % name)(
+                    amount, deadline)
+                if match and match[0] and match[1] > best[1]:
+                    best, strategy = match, name
+                    if best[1] >= confidence:
+                        break
+            payments, score = best[:2]
+            if not payments:
+                return payments, score
+            if claim and score >= confidence:
+                if not self._claim_payment_match(payments):
+                    # Held by another transaction, search without them
+                    session.claimed_payments.update(p.id for p in payments)
+                    continue
+            if not claim or score >= confidence:
+                # Below the confidence it is only proposed
+                session.claimed_payments.update(p.id for p in payments)
+                session.claimed_groups.update(
+                    p.group.id for p in payments if p.group)
+            if details is not None:
+                details['strategy'] = strategy
+                details['amounts'] = best[2] if len(best) > 2 else {}
+                details['accounts'] = best[3] if len(best) > 3 else {}
+            return payments, score
+
+    def _match_payments_prediction(self, amount, deadline):
+        """
+        Match the open payment of a party which pays amount regularly
+
+        With the party of the line, a single candidate is confident and the
+        oldest of many is only proposed. Without the party, the payment must
+        be the only candidate and it is only proposed.
         """
         pool = Pool()
+        Prediction = pool.get('account.payment.prediction')
+        Payment = pool.get('account.payment')
+        cursor = Transaction().connection.cursor()
+        session = self._get_payment_matching_session()
+
+        kind = 'receivable' if amount > _ZERO else 'payable'
+        domain = [
+            ('company', '=', self.company.id),
+            ('kind', '=', kind),
+            ('amount', '=', abs(amount)),
+            ('currency', '=', self.statement_currency.id),
+            ]
+        party = getattr(self, 'party', None)
+        if party:
+            domain.append(('party', '=', party.id))
+        predictions = Prediction.search(domain, limit=config.getint(
+                'account_bank_statement_payment', 'subset_size', default=20))
+        if not predictions:
+            return
+        date = datetime.date(self.date.year, self.date.month, self.date.day)
+        # The most regular parties expected around the date first
+        predictions.sort(key=lambda p: (
+                abs(((p.next_date or p.last_date) - date).days), -p.count))
+        candidates = []
+        for prediction in predictions:
+            if time.monotonic() > deadline:
+                return
+            query = self._get_open_payments_query(amount,
+                where=lambda p: ((p.party == prediction.party.id)
+                    & (p.journal == prediction.journal.id)
+                    & (p.pending_amount == abs(amount))))
+            cursor.execute(*query)
+            candidates.extend(i for i, in cursor
+                if i not in session.claimed_payments)
+            if not party and len(candidates) > 1:
+                # Without party only a unique candidate is expected
+                return
+        if candidates:
+            # The oldest open payment is the one expected
+            score = 0.85 if party and len(candidates) == 1 else 0.75
+            return [Payment(candidates[0])], score
+
+    def _match_payments_exact_group(self, amount, deadline):
+        payments = self._select_candidate_payments(
+            self._get_payment_candidates(amount))
+        if payments:
+            return payments, 1.0
+
+    def _match_payments_forecast(self, amount, deadline):
+        """
+        Match the payment with the closest expected movement of amount
+
+        Without the party of the line, the payment must be the only
+        candidate.
+        """
+        pool = Pool()
+        Forecast = pool.get('account.payment.forecast')
+        Payment = pool.get('account.payment')
+        forecast = Forecast.__table__()
+        cursor = Transaction().connection.cursor()
+        session = self._get_payment_matching_session()
+
+        date = self.date
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        where = ((forecast.company == self.company.id)
+            & (forecast.currency == self.statement_currency.id)
+            & (forecast.amount == amount)
+            & forecast.type.in_(['advanced', 'pending']))
+        party = getattr(self, 'party', None)
+        if party:
+            where &= (forecast.party == party.id)
+        cursor.execute(*forecast.select(forecast.payment, forecast.type,
+                where=where,
+                order_by=[
+                    Abs(Extract('EPOCH', forecast.date)
+                        - Extract('EPOCH', date)).asc,
+                    forecast.payment.asc],
+                limit=config.getint(
+                    'account_bank_statement_payment', 'subset_size',
+                    default=20)))
+        candidates = [(p, t) for p, t in cursor.fetchall()
+            if p not in session.claimed_payments]
+        if not candidates or (not party and len(candidates) > 1):
+            return
+        payment_id, type_ = candidates[0]
+        payment = Payment(payment_id)
+        accounts = {}
+        clearing_account = payment.journal.clearing_account
+        if type_ == 'advanced' and clearing_account:
+            # The advanced part is received on the clearing account
+            accounts[payment_id] = clearing_account
+        # Only the expected part of the payment is matched
+        return [payment], 0.85, {payment_id: abs(amount)}, accounts
+
+    def _match_payments_converted_group(self, amount, deadline):
+        group_ids = self._search_converted_groups(amount)
+        if group_ids:
+            kind = 'receivable' if amount > _ZERO else 'payable'
+            candidates = self._read_payment_candidates(group_ids, kind)
+            order = {g: i for i, g in enumerate(group_ids)}
+            candidates.sort(key=lambda r: order[r[0]])
+            payments = self._select_candidate_payments(candidates)
+            if payments:
+                return payments, 0.9
+
+    def _get_open_payments_query(self, amount, where=None):
+        """
+        Return the query of the ids of the open payments of the line kind
+        and currency, and with pending amount equal to amount if set
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Journal = pool.get('account.payment.journal')
+        payment = Payment.__table__()
+        journal = Journal.__table__()
+
+        kind = 'receivable' if amount > _ZERO else 'payable'
+        condition = ((payment.company == self.company.id)
+            & (payment.kind == kind)
+            & (payment.state == 'processing')
+            & (journal.currency == self.statement_currency.id))
+        if where is not None:
+            condition &= where(payment)
+        return payment.join(journal,
+            condition=payment.journal == journal.id
+            ).select(payment.id,
+            where=condition,
+            order_by=[payment.date.asc, payment.id.asc])
+
+    def _select_open_payments(self, query, count=1):
+        """
+        Return the payments of query not reserved by the session if there are
+        exactly count of them or None
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        cursor = Transaction().connection.cursor()
+        session = self._get_payment_matching_session()
+
+        cursor.execute(*query)
+        payment_ids = [i for i, in cursor
+            if i not in session.claimed_payments]
+        if len(payment_ids) == count:
+            return Payment.browse(payment_ids)
+
+    def _match_payments_reference(self, amount, deadline):
+        description = self.description
+        if not description:
+            return
+        query = self._get_open_payments_query(amount,
+            where=lambda p: ((p.reference != Null)
+                & (CharLength(p.reference) >= 3)
+                & (Position(p.reference, description) > 0)
+                & (p.pending_amount == abs(amount))))
+        payments = self._select_open_payments(query)
+        if payments:
+            return payments, 0.9
+
+    def _match_payments_party_amount(self, amount, deadline):
+        party = getattr(self, 'party', None)
+        if not party:
+            return
+        query = self._get_open_payments_query(amount,
+            where=lambda p: ((p.party == party.id)
+                & (p.pending_amount == abs(amount))))
+        payments = self._select_open_payments(query)
+        if payments:
+            return payments, 0.8
+
+    def _match_payments_subset(self, amount, deadline):
+        "Find the open payments of the party which sum the amount"
+        party = getattr(self, 'party', None)
+        if not party:
+            return
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        session = self._get_payment_matching_session()
+
+        search_amount = abs(amount)
+        query = self._get_open_payments_query(amount,
+            where=lambda p: ((p.party == party.id)
+                & (p.pending_amount > 0)
+                & (p.pending_amount <= search_amount)))
+        query.limit = config.getint(
+            'account_bank_statement_payment', 'subset_size', default=20)
+        cursor.execute(*query)
+        payments = [p for p in Payment.browse([i for i, in cursor])
+            if p.id not in session.claimed_payments]
+
+        # Sums reachable with the first payments and how
+        sums = {_ZERO: []}
+        for payment in payments:
+            for total, subset in list(sums.items()):
+                if time.monotonic() > deadline:
+                    return
+                total += payment.pending_amount
+                if total > search_amount or total in sums:
+                    continue
+                sums[total] = subset + [payment]
+                if total == search_amount:
+                    return sums[total], 0.6
+
+    @classmethod
+    def _select_candidate_payments(cls, candidates):
+        """
+        Return the payments of the first group without reconciled payments
+        nor payments reserved by the session
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        session = cls._get_payment_matching_session()
+        for group_id, rows in groupby(candidates, key=itemgetter(0)):
+            if group_id in session.claimed_groups:
+                continue
+            rows = list(rows)
+            # group, payment, amount, state, line, reconciliation, party,
+            # journal
+            payment_ids = [r[1] for r in rows]
+            if (all(r[5] is None for r in rows)
+                    and session.claimed_payments.isdisjoint(payment_ids)):
+                return Payment.browse(payment_ids)
+        return []
+
+    @classmethod
+    def _claim_payment_match(cls, payments):
+        """
+        Lock the payments and their groups until the end of the transaction.
+        Return False if another transaction already holds any of them.
+        """
+        groups = defaultdict(list)
+        for payment in payments:
+            groups[payment.group.id if payment.group else None].append(
+                payment.id)
+        for group_id, payment_ids in groups.items():
+            if group_id is None:
+                claimed = cls._claim_payments(payment_ids)
+            else:
+                claimed = cls._claim_payment_group(group_id, payment_ids)
+            if not claimed:
+                return False
+        return True
+
+    @classmethod
+    def _claim_payments(cls, payment_ids):
+        """
+        Lock the payments until the end of the transaction.
+        Return False if another transaction already holds any of them.
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        payment = Payment.__table__()
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+
+        if not database.has_select_for():
+            # SQLite serializes the transactions that write
+            return True
+        For = database.get_select_for_skip_locked()
+        locked = 0
+        for sub_ids in grouped_slice(payment_ids):
+            cursor.execute(*payment.select(payment.id,
+                    where=reduce_ids(payment.id, sub_ids),
+                    for_=For('UPDATE')))
+            locked += len(cursor.fetchall())
+        return locked == len(payment_ids)
+
+    @classmethod
+    def _claim_payment_group(cls, group_id, payment_ids):
+        """
+        Lock the group and its payments until the end of the transaction.
+        Return False if another transaction already holds any of them.
+        """
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        group = Group.__table__()
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+
+        if not database.has_select_for():
+            # SQLite serializes the transactions that write
+            return True
+        For = database.get_select_for_skip_locked()
+        cursor.execute(*group.select(group.id,
+                where=group.id == group_id,
+                for_=For('UPDATE')))
+        if not cursor.fetchone():
+            return False
+        return cls._claim_payments(payment_ids)
+
+    def _get_payment_candidates(self, amount):
+        """
+        Return the payments of the groups with total equal to amount as
+        tuples of group, payment, amount, state, line, reconciliation, party
+        and journal ids ordered by group
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
         Group = pool.get('account.payment.group')
+        totals = Payment.__table__()
+        group = Group.__table__()
 
         search_amount = abs(amount)
         if search_amount == _ZERO:
             return []
 
         kind = 'receivable' if amount > _ZERO else 'payable'
-        domain = [
-            ('journal.currency', '=', self.statement_currency),
-            ('kind', '=', kind),
-            ('total_amount', '=', search_amount),
-            ('company', '=', self.company.id),
-            ]
-        payments = []
-        for group in Group.search(domain):
-            found = True
-            for payment in group.payments:
-                if payment.line and payment.line.reconciliation:
-                    found = False
-                    break
-            if found:
-                payments = group.payments
-                break
-        return payments
+        having = Sum(totals.amount) == search_amount
+        if self._get_payment_windows():
+            having &= ~self._get_group_outside_window(totals.group)
+        # The window prunes the payments before they are grouped
+        group_ids = totals.join(group,
+            condition=(totals.group == group.id)
+            & (group.settled == Literal(False))
+            ).select(totals.group,
+            where=self._get_payment_window(totals),
+            group_by=totals.group,
+            having=having)
+        return self._read_payment_candidates(group_ids, kind,
+            currency=self.statement_currency)
 
-    def _search_payments_reconciliation(self):
+    def _get_payment_windows(self):
+        """
+        Return a dictionary with the number of days around the statement line
+        date of each payment journal with a window
+        """
         pool = Pool()
-        MoveLine = pool.get('account.bank.statement.move.line')
-        Configuration = pool.get('account.configuration')
-        config = Configuration(1)
+        Journal = pool.get('account.payment.journal')
+        session = self._get_payment_matching_session()
+        if self.company.id not in session.windows:
+            journals = Journal.search([
+                    ('company', '=', self.company.id),
+                    ('statement_window', '!=', None),
+                    ])
+            session.windows[self.company.id] = {
+                j.id: j.get_statement_window() for j in journals}
+        return session.windows[self.company.id]
+
+    def _get_payment_window(self, payment):
+        """
+        Return the SQL condition of the payment table within the date window
+        of its journal
+        """
+        windows = self._get_payment_windows()
+        if not windows:
+            return Literal(True)
+        date = datetime.date(self.date.year, self.date.month, self.date.day)
+        condition = ~payment.journal.in_(list(windows))
+        for journal_id, days in windows.items():
+            delta = datetime.timedelta(days=days)
+            condition |= ((payment.journal == journal_id)
+                & (payment.date >= date - delta)
+                & (payment.date <= date + delta))
+        return condition
+
+    def _get_group_outside_window(self, group):
+        """
+        Return the SQL condition of the group column having a payment outside
+        the date window of its journal
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        payment = Payment.__table__()
+        return Exists(payment.select(payment.id,
+                where=(payment.group == group)
+                & ~self._get_payment_window(payment)))
+
+    def _read_payment_candidates(self, groups, kind, currency=None):
+        """
+        Return the candidate tuples of the payments of groups, a list of ids
+        or a query
+        """
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        Payment = pool.get('account.payment')
+        Journal = pool.get('account.payment.journal')
+        Line = pool.get('account.move.line')
+        group = Group.__table__()
+        payment = Payment.__table__()
+        journal = Journal.__table__()
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        where = ((group.kind == kind)
+            & (group.company == self.company.id)
+            & (group.settled == Literal(False)))
+        if isinstance(groups, list):
+            where &= reduce_ids(group.id, groups)
+        else:
+            where &= group.id.in_(groups)
+        if currency:
+            where &= journal.currency == currency.id
+        query = (group
+            .join(journal, condition=group.journal == journal.id)
+            .join(payment, condition=payment.group == group.id)
+            .join(line, 'LEFT', condition=payment.line == line.id)
+            .select(group.id, payment.id, payment.amount, payment.state,
+                payment.line, line.reconciliation, payment.party,
+                group.journal,
+                where=where,
+                order_by=[group.id.asc, payment.date.desc,
+                    payment.id.asc]))
+        cursor.execute(*query)
+        return cursor.fetchall()
+
+    def _get_converted_group_totals(self, kind):
+        """
+        Return the totals of the groups of cross-currency journals converted
+        to the statement currency at the date of the line.
+
+        The result is a tuple with a dictionary of amount and list of group
+        id and tolerance, and the maximum tolerance.
+        It is computed once per matching session.
+        """
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        Payment = pool.get('account.payment')
+        Journal = pool.get('account.payment.journal')
+        Currency = pool.get('currency.currency')
+        group = Group.__table__()
+        payment = Payment.__table__()
+        journal = Journal.__table__()
+        cursor = Transaction().connection.cursor()
+
+        session = self._get_payment_matching_session()
+        currency = self.statement_currency
+        date = datetime.date(self.date.year, self.date.month, self.date.day)
+        key = (self.company.id, kind, currency.id, date)
+        if key in session.converted_totals:
+            return session.converted_totals[key]
+
+        query = (group
+            .join(journal, condition=group.journal == journal.id)
+            .join(payment, condition=payment.group == group.id)
+            .select(group.id, journal.currency,
+                journal.statement_currency_tolerance, Sum(payment.amount),
+                where=((journal.statement_cross_currency == Literal(True))
+                    & (journal.currency != currency.id)
+                    & (group.kind == kind)
+                    & (group.company == self.company.id)
+                    & (group.settled == Literal(False))
+                    & self._get_payment_window(payment)),
+                group_by=[group.id, journal.currency,
+                    journal.statement_currency_tolerance]))
+        if self._get_payment_windows():
+            query.having = ~self._get_group_outside_window(group.id)
+        cursor.execute(*query)
+
+        rates = {}
+        totals = defaultdict(list)
+        max_tolerance = _ZERO
+        with Transaction().set_context(date=date):
+            for group_id, currency_id, tolerance, total in cursor:
+                if currency_id not in rates:
+                    rates[currency_id] = Currency.compute(
+                        Currency(currency_id), Decimal(1), currency,
+                        round=False)
+                amount = currency.round(Decimal(total) * rates[currency_id])
+                tolerance = tolerance or _ZERO
+                totals[amount].append((group_id, tolerance))
+                max_tolerance = max(max_tolerance, tolerance)
+        session.converted_totals[key] = result = (totals, max_tolerance)
+        return result
+
+    def _search_converted_groups(self, amount):
+        """
+        Return the ids of the cross-currency groups with converted total
+        equal to amount within their tolerance ordered by difference
+        """
+        search_amount = abs(amount)
+        if search_amount == _ZERO:
+            return []
+        kind = 'receivable' if amount > _ZERO else 'payable'
+        totals, max_tolerance = self._get_converted_group_totals(kind)
+        if not totals:
+            return []
+
+        currency = self.statement_currency
+        steps = int(max_tolerance / currency.rounding)
+        group_ids = []
+        for step in sorted(range(-steps, steps + 1), key=abs):
+            difference = step * currency.rounding
+            for group_id, tolerance in totals.get(
+                    currency.round(search_amount + difference), []):
+                if abs(difference) <= tolerance:
+                    group_ids.append(group_id)
+        return group_ids
+
+    def _get_group_amounts(self, kind):
+        """
+        Return the sorted list of the totals of the groups of the journals
+        with a tolerance and the list of the group id, journal id, minimum
+        and maximum payment date at the same positions.
+        It is computed once per matching session.
+        """
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        Payment = pool.get('account.payment')
+        Journal = pool.get('account.payment.journal')
+        group = Group.__table__()
+        payment = Payment.__table__()
+        journal = Journal.__table__()
+        cursor = Transaction().connection.cursor()
+
+        session = self._get_payment_matching_session()
+        currency = self.statement_currency
+        key = (self.company.id, kind, currency.id)
+        if key in session.group_amounts:
+            return session.group_amounts[key]
+
+        total = Sum(payment.amount)
+        cursor.execute(*group
+            .join(journal, condition=group.journal == journal.id)
+            .join(payment, condition=payment.group == group.id)
+            .select(total, group.id, group.journal,
+                Min(payment.date), Max(payment.date),
+                where=(((journal.statement_tolerance_amount > 0)
+                        | (journal.statement_tolerance_percent > 0))
+                    & (journal.currency == currency.id)
+                    & (group.kind == kind)
+                    & (group.company == self.company.id)
+                    & (group.settled == Literal(False))),
+                group_by=[group.id, group.journal],
+                order_by=[total.asc, group.id.asc]))
+        amounts, entries = [], []
+        for amount, *entry in cursor:
+            amounts.append(Decimal(str(amount)))
+            entries.append(tuple(entry))
+        session.group_amounts[key] = result = (amounts, entries)
+        return result
+
+    def _search_groups_within_tolerance(self, amount):
+        """
+        Return the ids of the groups with total within the tolerance of their
+        journal from amount, ordered by difference
+        """
+        pool = Pool()
+        Journal = pool.get('account.payment.journal')
+
+        search_amount = abs(amount)
+        if search_amount == _ZERO:
+            return []
+        kind = 'receivable' if amount > _ZERO else 'payable'
+        amounts, entries = self._get_group_amounts(kind)
+        if not amounts:
+            return []
+
+        journals = {j.id: j for j in Journal.browse(
+                list({e[1] for e in entries}))}
+        max_amount = max(j.statement_tolerance_amount or _ZERO
+            for j in journals.values())
+        max_percent = max(j.statement_tolerance_percent or _ZERO
+            for j in journals.values())
+        # Bounds of the totals for which one of the tolerances could apply
+        lower = min(search_amount - max_amount,
+            search_amount / (1 + max_percent))
+        upper = max(search_amount + max_amount,
+            search_amount / (1 - max_percent))
+
+        windows = self._get_payment_windows()
+        date = datetime.date(self.date.year, self.date.month, self.date.day)
+        found = []
+        for i in range(
+                bisect.bisect_left(amounts, lower),
+                bisect.bisect_right(amounts, upper)):
+            total = amounts[i]
+            group_id, journal_id, min_date, max_date = entries[i]
+            difference = abs(total - search_amount)
+            if difference > journals[journal_id].get_statement_tolerance(
+                    total):
+                continue
+            if journal_id in windows:
+                delta = datetime.timedelta(days=windows[journal_id])
+                if min_date < date - delta or max_date > date + delta:
+                    continue
+            found.append((difference, group_id))
+        return [g for _, g in sorted(found)]
+
+    def _match_payments_tolerance(self, amount, deadline):
+        group_ids = self._search_groups_within_tolerance(amount)
+        if group_ids:
+            kind = 'receivable' if amount > _ZERO else 'payable'
+            candidates = self._read_payment_candidates(group_ids, kind)
+            order = {g: i for i, g in enumerate(group_ids)}
+            candidates.sort(key=lambda r: order[r[0]])
+            payments = self._select_candidate_payments(candidates)
+            if payments:
+                return payments, 0.7
+
+    def _get_fee_proposal(self, proposals, amount):
+        """
+        Return the PaymentProposal of the difference between amount and the
+        proposals if the journal of the payments has a fee account
+        """
+        journals = {p.payment.journal for p in proposals}
+        if len(journals) != 1:
+            return
+        journal, = journals
+        if not journal.statement_fee_account:
+            return
+        total = sum(p.amount for p in proposals)
+        difference = self.statement_currency.round(abs(amount) - total)
+        if (difference
+                and abs(difference) <= journal.get_statement_tolerance(total)):
+            return PaymentProposal(self, None,
+                account=journal.statement_fee_account, amount=difference,
+                score=proposals[0].score)
+
+    def _get_payment_proposals(self, claim=False):
+        """
+        Return the list of PaymentProposal for the line without saving
+        anything
+
+        If claim is set, the payments of a match that reaches the confidence
+        are locked until the end of the transaction.
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Account = pool.get('account.account')
+        Line = pool.get('account.move.line')
 
         amount = self.company_amount - self.moves_amount
         kind = 'receivable' if amount > _ZERO else 'payable'
-        payments = self._search_payments(amount)
+        details = {}
+        payments, score = self._match_payments(
+            amount, claim=claim, details=details)
+        amounts = details.get('amounts', {})
+        accounts = details.get('accounts', {})
+
+        payments = [p for p in payments
+            if p.state not in ('draft', 'failed')]
+        payment_lines = self._get_payment_lines(payments)
 
+        date = datetime.date(self.date.year, self.date.month, self.date.day)
+        proposals = []
         for payment in payments:
-            if payment.state in ('draft', 'failed'):
+            pending_amount = payment.pending_amount
+            if pending_amount is None:
+                pending_amount = payment.amount
+            elif not pending_amount:
+                # Already settled by other statement lines
                 continue
-            move_line = MoveLine()
-            if payment.line:
-                line_amount = abs(payment.line.debit - payment.line.credit)
-                if line_amount == payment.amount:
-                    line = payment.line
-                    line.bank_statement_line_counterpart = self
-                    line.save()
+            same_currency = payment.currency == self.statement_currency
+            if payment.id in amounts:
+                payment_amount = amounts[payment.id]
+            elif same_currency:
+                payment_amount = pending_amount
+            else:
+                with Transaction().set_context(date=date):
+                    payment_amount = Currency.compute(payment.currency,
+                        pending_amount, self.statement_currency)
+            proposal = PaymentProposal(self, payment, group=payment.group,
+                amount=payment_amount, score=score)
+            if payment.id in payment_lines:
+                line_id, account_id, line_amount, counterpart = (
+                    payment_lines[payment.id])
+                if counterpart is not None:
+                    # Already counterpart of a statement line
                     continue
-                move_line.account = payment.line.account
+                proposal.account = Account(account_id)
+                if same_currency and line_amount == payment.amount:
+                    proposal.counterpart = Line(line_id)
             else:
-                party_account = getattr(payment.party, 'account_%s' % kind)
-                if party_account:
-                    account = party_account
-                else:
-                    account = getattr(config, 'default_account_%s' % kind)
-                move_line.account = account
-            move_line.party = payment.party
-            move_line.amount = payment.amount
-            move_line.date = datetime.date(self.date.year, self.date.month,
-                self.date.day)
-            move_line.line = self
-            move_line.description = payment.reference
-            move_line.save()
+                proposal.account = self._get_payment_party_account(
+                    payment, kind)
+            if payment.id in accounts:
+                proposal.account = accounts[payment.id]
+                proposal.counterpart = None
+            proposals.append(proposal)
+        if (proposals and len(proposals) == len(payments)
+                and details.get('strategy') == 'converted_group'):
+            # Each payment is converted on its own so the difference with
+            # amount goes to the last one
+            proposals[-1].amount += abs(amount) - sum(
+                p.amount for p in proposals)
+        # Only the tolerance strategy matches a total different from amount
+        if proposals and details.get('strategy') == 'tolerance':
+            fee = self._get_fee_proposal(proposals, amount)
+            if fee:
+                proposals.append(fee)
+        return proposals
+
+    @staticmethod
+    def _get_payment_party_account(payment, kind):
+        "Return the account of the proposal of a payment without line"
+        pool = Pool()
+        Configuration = pool.get('account.configuration')
+        account = getattr(payment.party, 'account_%s' % kind)
+        if not account:
+            account = getattr(Configuration(1), 'default_account_%s' % kind)
+        return account
+
+    @classmethod
+    def _get_payment_lines(cls, payments):
+        """
+        Return a dictionary with the line id, account id, absolute amount and
+        statement line counterpart of the line of each payment
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Line = pool.get('account.move.line')
+        payment = Payment.__table__()
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {}
+        for sub_ids in grouped_slice([p.id for p in payments]):
+            cursor.execute(*payment.join(line,
+                    condition=payment.line == line.id
+                    ).select(payment.id, line.id, line.account,
+                    Abs(line.debit - line.credit),
+                    line.bank_statement_line_counterpart,
+                    where=reduce_ids(payment.id, sub_ids)))
+            for payment_id, line_id, account_id, amount, counterpart in (
+                    cursor):
+                result[payment_id] = (
+                    line_id, account_id, Decimal(str(amount)), counterpart)
+        return result
+
+    @classmethod
+    def propose_payments(cls, lines):
+        "Return the list of PaymentProposal for all the lines"
+        proposals = []
+        for line in lines:
+            proposals.extend(line._get_payment_proposals())
+        return proposals
+
+    @classmethod
+    def get_payment_proposals(cls, lines):
+        return [p.to_dict() for p in cls.propose_payments(lines)]
+
+    @classmethod
+    def accept_payment_proposals(cls, values):
+        proposals = [PaymentProposal.from_dict(v) for v in values]
+        cls.check_payment_proposals(proposals)
+        cls.apply_payment_proposals(proposals)
+
+    @classmethod
+    def check_payment_proposals(cls, proposals):
+        "Check the proposals received from the client can be applied"
+        line_proposals = defaultdict(list)
+        for proposal in proposals:
+            line_proposals[proposal.line].append(proposal)
+        payments = set()
+        for line, sub_proposals in line_proposals.items():
+            for proposal in sub_proposals:
+                if proposal.payment:
+                    if proposal.payment in payments:
+                        line._raise_payment_proposal_invalid()
+                    payments.add(proposal.payment)
+            line._check_payment_proposals(sub_proposals)
+
+    def _raise_payment_proposal_invalid(self):
+        raise UserError(gettext('account_bank_statement_payment.'
+                'msg_payment_proposal_invalid', line=self.rec_name))
+
+    def _check_payment_proposals(self, proposals):
+        """
+        Check the account, amount and counterpart of the proposals for the
+        line against its state and the payments
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+
+        if self.state != 'confirmed':
+            self._raise_payment_proposal_invalid()
+        amount = self.company_amount - self.moves_amount
+        kind = 'receivable' if amount > _ZERO else 'payable'
+        date = datetime.date(self.date.year, self.date.month, self.date.day)
+        paid = [p for p in proposals if p.payment]
+        for proposal in paid:
+            payment = proposal.payment
+            if (payment.company != self.company
+                    or payment.kind != kind
+                    or payment.state not in ('processing', 'succeeded')
+                    or proposal.group != payment.group
+                    or proposal.amount is None):
+                self._raise_payment_proposal_invalid()
+            if payment.line:
+                account = payment.line.account
+            else:
+                account = self._get_payment_party_account(payment, kind)
+            pending_amount = payment.pending_amount
+            if pending_amount is None:
+                pending_amount = payment.amount
+            with Transaction().set_context(date=date):
+                pending_amount = Currency.compute(payment.currency,
+                    pending_amount, self.statement_currency)
+            if (payment.currency != self.statement_currency
+                    and payment.journal.statement_cross_currency):
+                # The conversion difference of the match
+                pending_amount += (
+                    payment.journal.statement_currency_tolerance or _ZERO)
+            # The clearing account receives the advanced part
+            accounts = {account, payment.journal.clearing_account} - {None}
+            if (proposal.account not in accounts
+                    or abs(proposal.amount) > pending_amount):
+                self._raise_payment_proposal_invalid()
+            if proposal.counterpart and (
+                    proposal.counterpart != payment.line
+                    or proposal.counterpart.bank_statement_line_counterpart
+                    or payment.currency != self.statement_currency
+                    or abs(proposal.counterpart.debit
+                        - proposal.counterpart.credit) != payment.amount):
+                self._raise_payment_proposal_invalid()
+        for proposal in proposals:
+            if proposal.payment:
+                continue
+            # Only the difference of a tolerance match can be without payment
+            journals = {p.payment.journal for p in paid}
+            if len(journals) != 1 or proposal.amount is None:
+                self._raise_payment_proposal_invalid()
+            journal, = journals
+            total = sum(p.amount for p in paid)
+            if (proposal.account != journal.statement_fee_account
+                    or abs(proposal.amount)
+                    > journal.get_statement_tolerance(total)):
+                self._raise_payment_proposal_invalid()
+
+    @classmethod
+    def apply_payment_proposals(cls, proposals):
+        """
+        Lock the payments and create the statement move lines and set the
+        counterparts of the proposals
+        """
+        pool = Pool()
+        MoveLine = pool.get('account.bank.statement.move.line')
+        Line = pool.get('account.move.line')
+
+        if not cls._claim_payment_match(
+                list({p.payment for p in proposals if p.payment})):
+            raise UserError(gettext('account_bank_statement_payment.'
+                    'msg_payment_proposal_locked'))
+
+        counterparts = defaultdict(list)
+        move_lines = []
+        for proposal in proposals:
+            statement_line = proposal.line
+            if proposal.counterpart:
+                counterparts[statement_line].append(proposal.counterpart)
+                continue
+            move_line = MoveLine()
+            move_line.account = proposal.account
+            if proposal.payment:
+                move_line.party = proposal.payment.party
+                move_line.description = proposal.payment.reference
+            move_line.amount = proposal.amount
+            move_line.date = datetime.date(statement_line.date.year,
+                statement_line.date.month, statement_line.date.day)
+            move_line.line = statement_line
+            move_lines.append(move_line)
+        to_write = []
+        for statement_line, lines in counterparts.items():
+            to_write.extend((lines, {
+                        'bank_statement_line_counterpart': statement_line.id,
+                        }))
+        if to_write:
+            Line.write(*to_write)
+        if move_lines:
+            MoveLine.save(move_lines)
+
+    def _search_payments_reconciliation(self):
+        """
+        Apply the proposals of the line that reach the confidence and return
+        the others
+        """
+        confidence = self._get_payment_match_confidence()
+        proposals = self._get_payment_proposals(claim=True)
+        if proposals and proposals[0].score >= confidence:
+            self.apply_payment_proposals(proposals)
+            return []
+        return proposals
 
     def _search_reconciliation(self):
         super(StatementLine, self)._search_reconciliation()
         self._search_payments_reconciliation()
 
+    @classmethod
+    def post(cls, statement_lines):
+        pool = Pool()
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        Prediction = pool.get('account.payment.prediction')
+
+        to_settle = [l.id for st_line in statement_lines
+            if st_line.state != 'posted'
+            for l in st_line.lines if l.payment]
+        # Payments are settled once for all the lines instead of one by one
+        # from create_move
+        with Transaction().set_context(_bank_statement_payment_deferred=True):
+            super(StatementLine, cls).post(statement_lines)
+        StatementMoveLine.settle_payments(StatementMoveLine.browse(to_settle))
+        cls._update_payments_pending_amount(statement_lines)
+        Prediction.update_move_lines(StatementMoveLine.browse(to_settle))
+
+    @classmethod
+    def cancel(cls, statement_lines):
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Reconciliation = pool.get('account.move.reconciliation')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        Prediction = pool.get('account.payment.prediction')
+
+        # Collect what the posting made before the moves are cancelled
+        posted = [l for l in statement_lines if l.state == 'posted']
+        parties = {l.payment.party for st_line in posted
+            for l in st_line.lines if l.payment}
+        previous_states, reconciliation_ids = cls._get_cancel_links(posted)
+        StatementMoveLine._set_payment_previous_states(
+            {l.id: None for st_line in posted for l in st_line.lines})
+        # Unreconcile all at once instead of line by line
+        for sub_ids in grouped_slice(reconciliation_ids):
+            Reconciliation.delete(Reconciliation.browse(sub_ids))
+
+        super(StatementLine, cls).cancel(statement_lines)
+
+        transitions = defaultdict(list)
+        for payment in Payment.browse(
+                cls._get_unsettled_payments(list(previous_states))):
+            transitions[previous_states[payment.id]].append(payment)
+        for sub_payments in grouped_slice(transitions.pop('processing', [])):
+            Payment.proceed(list(sub_payments))
+        Payment.transition_from_statement(transitions)
+        cls._update_payments_pending_amount(statement_lines)
+        # Remove the history that the posting added
+        if parties:
+            Prediction.rebuild(parties)
+
+    @classmethod
+    def _get_cancel_links(cls, statement_lines):
+        """
+        Return the state of the payments before the posting of the statement
+        lines changed them and the ids of the reconciliations it made
+        """
+        pool = Pool()
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        Reconciliation = pool.get('account.move.reconciliation')
+        move_line = StatementMoveLine.__table__()
+        reconciliation = Reconciliation.__table__()
+        cursor = Transaction().connection.cursor()
+
+        previous_states, reconciliation_ids = {}, set()
+        for sub_lines in grouped_slice(statement_lines):
+            where = reduce_ids(move_line.line, [l.id for l in sub_lines])
+            cursor.execute(*move_line.select(
+                    move_line.payment, move_line.payment_previous_state,
+                    where=where
+                    & (move_line.payment_previous_state != Null),
+                    order_by=move_line.id.desc))
+            # The state before the first change of the payment
+            previous_states.update(cursor)
+            cursor.execute(*reconciliation.select(reconciliation.id,
+                    where=reconciliation.bank_statement_move_line.in_(
+                        move_line.select(move_line.id, where=where))))
+            reconciliation_ids.update(i for i, in cursor)
+        return previous_states, sorted(reconciliation_ids)
+
+    @classmethod
+    def _get_unsettled_payments(cls, payment_ids):
+        """
+        Return the ids of the succeeded or failed payments that no posted
+        statement line settles
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        payment = Payment.__table__()
+        move_line = StatementMoveLine.__table__()
+        line = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = []
+        for sub_ids in grouped_slice(payment_ids):
+            settled = move_line.join(line,
+                condition=move_line.line == line.id
+                ).select(move_line.payment,
+                where=reduce_ids(move_line.payment, sub_ids)
+                & (line.state == 'posted'))
+            cursor.execute(*payment.select(payment.id,
+                    where=reduce_ids(payment.id, sub_ids)
+                    & payment.state.in_(['succeeded', 'failed'])
+                    & ~payment.id.in_(settled)))
+            result.extend(i for i, in cursor)
+        return result
+
+    @classmethod
+    def _update_payments_pending_amount(cls, statement_lines):
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        payments = {l.payment for st_line in statement_lines
+            for l in st_line.lines if l.payment}
+        if payments:
+            Payment.update_pending_amount(list(payments))
+
+    @classmethod
+    def import_payment_returns(cls, statement_line, file):
+        """
+        Fail the payments returned in file, a binary file object, and add
+        their negative move lines to statement_line.
+        Return the number of returned payments.
+
+        All the references are checked before any payment is changed.
+        """
+        index = cls._get_payment_return_index(statement_line.company)
+        returns, used, unknown = [], set(), []
+        for reference, amount, reason in cls._parse_payment_returns(file):
+            for payment_id, payment_amount in index.get(reference, []):
+                if payment_id in used:
+                    continue
+                if amount is not None and abs(amount) != payment_amount:
+                    continue
+                used.add(payment_id)
+                returns.append((payment_id, reason))
+                break
+            else:
+                unknown.append(reference)
+        if unknown:
+            raise UserError(gettext(
+                    'account_bank_statement_payment'
+                    '.msg_payment_return_unknown',
+                    references=', '.join(unknown[:10])))
+        for sub_returns in grouped_slice(returns):
+            cls._process_payment_returns(statement_line, list(sub_returns))
+        return len(returns)
+
+    @classmethod
+    def _parse_payment_returns(cls, file):
+        """
+        Yield the reference, amount and reason of each return of file
+
+        The file is CSV with the reference, and optionally the amount and
+        the reason, on each row. Only the first row can be a header.
+        """
+        file = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        sample = file.read(4096)
+        file.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        for number, row in enumerate(csv.reader(file, dialect), 1):
+            row = [c.strip() for c in row] + [''] * 2
+            reference, amount, reason = row[:3]
+            if not reference:
+                continue
+            try:
+                amount = Decimal(amount.replace(',', '.')) if amount else None
+            except InvalidOperation:
+                if number == 1:
+                    # Header
+                    continue
+                raise UserError(gettext(
+                        'account_bank_statement_payment'
+                        '.msg_payment_return_amount_invalid',
+                        row=number, amount=amount))
+            yield reference, amount, reason or None
+
+    @classmethod
+    def _get_payment_return_index(cls, company):
+        """
+        Return a dictionary with the list of id and amount of the payments
+        that can be returned for each reference
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        payment = Payment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        index = defaultdict(list)
+        cursor.execute(*payment.select(
+                payment.reference, payment.id, payment.amount,
+                where=(payment.company == company.id)
+                & (payment.reference != Null)
+                & payment.state.in_(['processing', 'succeeded']),
+                order_by=[payment.date.asc, payment.id.asc]))
+        for reference, payment_id, amount in cursor:
+            index[reference].append((payment_id, Decimal(str(amount))))
+        return index
+
+    @classmethod
+    def _process_payment_returns(cls, statement_line, returns):
+        """
+        Fail the payments and create their negative move lines for the list
+        of payment id and reason
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        AddPayment = pool.get(
+            'account.bank.statement.payment.add', type='wizard')
+
+        payments = Payment.browse([i for i, _ in returns])
+        # Kept on the lines so cancelling them reverts the payments
+        previous_states = {p.id: p.state for p in payments}
+        with Transaction().set_context(from_account_bank_statement_line=True):
+            Payment.fail([p for p in payments if p.state != 'failed'])
+
+        values = []
+        for payment in payments:
+            amount = payment.amount
+            if payment.kind == 'receivable':
+                amount *= -1
+            values.append({
+                    'line': statement_line.id,
+                    'payment': payment.id,
+                    'amount': amount,
+                    })
+        date = statement_line.date.date()
+        to_create = []
+        for move_line, (_, reason) in zip(
+                StatementMoveLine._apply_payments(values), returns):
+            payment = move_line.payment
+            move_line.date = date
+            move_line.party = move_line.party or payment.party
+            move_line.account = (move_line.account
+                or AddPayment._get_payment_account(payment))
+            move_line.description = reason or payment.reference
+            if previous_states[payment.id] != 'failed':
+                move_line.payment_previous_state = previous_states[payment.id]
+            to_create.append(move_line._save_values())
+        StatementMoveLine.create(to_create)
+
+    @classmethod
+    def copy(cls, lines, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('payment_match_fingerprint', None)
+        return super(StatementLine, cls).copy(lines, default=default)
+
 
 class StatementMoveLine(metaclass=PoolMeta):
     __name__ = 'account.bank.statement.move.line'
@@ -101,7 +1651,7 @@ class StatementMoveLine(metaclass=PoolMeta):
                 ('cancelled', "Cancelled"),
                 ('posted', 'Posted'),
                 ], 'State'),
-        'on_change_with_line_state')
+        'get_line_state', searcher='search_line_state')
     payment = fields.Many2One('account.payment', 'Payment',
         domain=[
             If(Bool(Eval('party')), [('party', '=', Eval('party'))], []),
@@ -111,6 +1661,30 @@ class StatementMoveLine(metaclass=PoolMeta):
                     ('state', 'in', ['processing', 'succeeded']),
                     ('state', 'in', ['processing', 'failed']))),
             ])
+    payment_previous_state = fields.Selection([
+            (None, ''),
+            ('processing', 'Processing'),
+            ('succeeded', 'Succeeded'),
+            ('failed', 'Failed'),
+            ], 'Payment Previous State', readonly=True,
+        help='The state of the payment before the posting of the line '
+        'changed it.')
+
+    @classmethod
+    def __register__(cls, module):
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        payment = Payment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        super(StatementMoveLine, cls).__register__(module)
+
+        # The pending amount is computed from the payment column of the
+        # lines, which is only created now on the first installation
+        cursor.execute(*payment.select(payment.id,
+                where=payment.pending_amount == Null))
+        for sub_ids in grouped_slice([i for i, in cursor]):
+            Payment._update_pending_amount(list(sub_ids))
 
     @classmethod
     def __setup__(cls):
@@ -122,6 +1696,58 @@ class StatementMoveLine(metaclass=PoolMeta):
                     clause._condition = (Bool(Eval('account'))
                         & ~Bool(Eval('payment')))
             cls.invoice.depends.add('payment')
+        cls.__rpc__.update({
+                'get_payment_values': RPC(),
+                })
+
+    @classmethod
+    def get_payment_values(cls, values):
+        """
+        Return the party, account, invoice and amount that on_change_payment
+        sets for each dictionary of statement line and payment ids
+        (and optionally party, account and amount)
+        """
+        result = []
+        for record in cls._apply_payments(values):
+            result.append({
+                    'party': record.party.id if record.party else None,
+                    'account': record.account.id if record.account else None,
+                    'invoice': record.invoice.id if record.invoice else None,
+                    'amount': record.amount,
+                    })
+        return result
+
+    @classmethod
+    def _apply_payments(cls, values):
+        """
+        Return new instances with the statement line and payment of values
+        on which on_change_payment has been applied
+        """
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+        Payment = pool.get('account.payment')
+        Party = pool.get('party.party')
+        Account = pool.get('account.account')
+
+        # Browse all the records at once to read them in bulk
+        lines = {l.id: l for l in StatementLine.browse(
+                list({v['line'] for v in values}))}
+        payments = {p.id: p for p in Payment.browse(
+                list({v['payment'] for v in values}))}
+        records = []
+        for value in values:
+            record = cls()
+            record.line = lines[value['line']]
+            record.payment = payments[value['payment']]
+            record.party = (Party(value['party'])
+                if value.get('party') else None)
+            record.account = (Account(value['account'])
+                if value.get('account') else None)
+            record.amount = value.get('amount')
+            record.invoice = None
+            record.on_change_payment()
+            records.append(record)
+        return records
 
     @fields.depends('line', '_parent_line.state')
     def on_change_with_line_state(self, name=None):
@@ -129,6 +1755,28 @@ class StatementMoveLine(metaclass=PoolMeta):
         StatementLine = pool.get('account.bank.statement.line')
         return self.line.state if self.line else StatementLine.default_state()
 
+    @classmethod
+    def get_line_state(cls, records, name):
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+        table = cls.__table__()
+        line = StatementLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        default = StatementLine.default_state()
+        states = dict.fromkeys([r.id for r in records], default)
+        for sub_ids in grouped_slice(records):
+            cursor.execute(*table.join(line,
+                    condition=table.line == line.id
+                    ).select(table.id, line.state,
+                    where=reduce_ids(table.id, [r.id for r in sub_ids])))
+            states.update(cursor)
+        return states
+
+    @classmethod
+    def search_line_state(cls, name, clause):
+        return [('line.state',) + tuple(clause[1:])]
+
     @fields.depends('party', 'payment', 'account',
         methods=['on_change_account'])
     def on_change_party(self):
@@ -185,10 +1833,15 @@ class StatementMoveLine(metaclass=PoolMeta):
                 else:
                     self.account = clearing_account
             if (not self.amount and self.line and self.line.journal):
+                payment_amount = self.payment.amount
+                if (self.payment.pending_amount is not None
+                        and not (clearing_account
+                            and self.account == clearing_account)):
+                    payment_amount = self.payment.pending_amount
                 with Transaction().set_context(date=self.payment.date):
                     amount = Currency.compute(
                         self.payment.currency,
-                        self.payment.amount,
+                        payment_amount,
                         self.line.journal.currency)
                 if clearing_account and self.account == clearing_account:
                     if (self.payment.journal.clearing_percent < Decimal(1)
@@ -202,81 +1855,194 @@ class StatementMoveLine(metaclass=PoolMeta):
                     self.amount *= -1
 
     def create_move(self):
+        move = super(StatementMoveLine, self).create_move()
+
+        if (move and self.payment
+                and not Transaction().context.get(
+                    '_bank_statement_payment_deferred')):
+            self.settle_payments([self])
+        return move
+
+    @classmethod
+    def settle_payments(cls, lines):
+        """
+        Update the state of the payments of the posted lines, post their
+        clearing moves and reconcile them.
+        """
         pool = Pool()
-        Currency = pool.get('currency.currency')
         Move = pool.get('account.move')
-        MoveLine = pool.get('account.move.line')
         Payment = pool.get('account.payment')
 
-        move = super(StatementMoveLine, self).create_move()
+        lines = [l for l in lines if l.payment and l.move]
+        transitions = defaultdict(list)
+        states = {}
+        previous_states = {}
+        for line in lines:
+            payment = line.payment
+            previous_state = states.get(payment.id, payment.state)
+            state = line._get_payment_transition(previous_state)
+            if not state:
+                continue
+            if payment.id in states:
+                # The payment changes twice in the same run
+                Payment.transition_from_statement(transitions)
+                transitions.clear()
+                states.clear()
+            transitions[state].append(payment)
+            states[payment.id] = state
+            previous_states[line.id] = previous_state
+        Payment.transition_from_statement(transitions)
+        cls._set_payment_previous_states(previous_states)
 
-        if not move:
-            return
+        clearing_moves = {l.payment.clearing_move for l in lines
+            if l.payment.clearing_move
+            and l.payment.clearing_move.state != 'posted'}
+        if clearing_moves:
+            Move.post(list(clearing_moves))
 
-        if self.payment:
-            payment_amount = Currency.compute(self.payment.currency,
-                self.payment.amount, self.line.statement.journal.currency)
-            if self.payment.kind == 'payable':
-                payment_amount *= -1
-
-            if (self.payment.journal.clearing_account
-                    and self.payment.journal.clearing_percent < Decimal(1)):
-                advancement_amount = (payment_amount
-                    * self.payment.journal.clearing_percent)
-                pending_amount = (payment_amount
-                    * (Decimal(1) - self.payment.journal.clearing_percent))
-            else:
-                advancement_amount = pending_amount = None
-
-            if (self.payment.state in ('processing', 'succeeded')
-                    and not self.payment.journal.advance
-                    and ((self.amount == -payment_amount)
-                        or (advancement_amount
-                            and self.amount == -advancement_amount))):
-                with Transaction().set_context(from_account_bank_statement_line=True):
-                    Payment.fail([self.payment])
-            elif (self.payment.state in ('processing', 'failed')
-                    and ((self.payment.line
-                            and  self.account == self.payment.line.account
-                            and self.amount == pending_amount)
-                        or (self.payment.journal.advance
-                            and self.account
-                            != self.payment.journal.clearing_account
-                            and self.amount == payment_amount))):
-                Payment.succeed([self.payment])
-
-            if (self.payment.clearing_move
-                    and self.payment.clearing_move.state != 'posted'):
-                Move.post([self.payment.clearing_move])
-
-            to_reconcile = defaultdict(list)
-            if not self.payment.line:
-                raise UserError(gettext('account_bank_statement_payment.'
-                        'payment_without_account_move',
-                        payment=self.payment.rec_name))
-            lines = move.lines + (self.payment.line,)
-            if self.payment.clearing_move:
-                lines += self.payment.clearing_move.lines
-            elif (self.payment.journal.clearing_account
-                    and self.payment.journal.advance
-                    and self.account == self.payment.journal.clearing_account):
-                for statement_move_line in self.search([
-                            ('payment', '=', self.payment),
-                            ('account', '=', self.account),
-                            ('line.state', '=', 'posted'),
-                            ]):
-                    lines += statement_move_line.move.lines
-
-            for line in lines:
-                if line.account.reconcile and not line.reconciliation:
-                    key = (
-                        line.account.id,
-                        line.party.id if line.party else None)
-                    to_reconcile[key].append(line)
-            for lines in list(to_reconcile.values()):
-                if not sum((x.debit - x.credit) for x in lines):
-                    MoveLine.reconcile(lines)
-        return move
+        for sub_lines in grouped_slice(lines):
+            cls._reconcile_payments(list(sub_lines))
+
+    @classmethod
+    def _reconcile_payments(cls, lines):
+        """
+        Reconcile the payments of the lines with a single call and link the
+        reconciliations to their lines
+        """
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+
+        lines_list, line_ids, used = [], [], set()
+
+        def reconcile():
+            if lines_list:
+                reconciliations = MoveLine.reconcile(*lines_list)
+                cls._set_payment_reconciliations(
+                    {r.id: l for r, l in zip(reconciliations, line_ids)})
+            lines_list.clear()
+            line_ids.clear()
+            used.clear()
+
+        for line in lines:
+            to_reconcile = line._get_payment_reconciliations()
+            if any(l.id in used for ls in to_reconcile for l in ls):
+                # The lines of the payment are shared with a previous line
+                reconcile()
+                to_reconcile = cls(line.id)._get_payment_reconciliations()
+            for move_lines in to_reconcile:
+                lines_list.append(move_lines)
+                line_ids.append(line.id)
+                used.update(l.id for l in move_lines)
+        reconcile()
+
+    @classmethod
+    def _set_payment_previous_states(cls, previous_states):
+        """
+        Store the state of the payments before the posting changed them for
+        the dictionary of line id and state
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        line_ids = defaultdict(list)
+        for line_id, state in previous_states.items():
+            line_ids[state].append(line_id)
+        for state, ids in line_ids.items():
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                        [table.payment_previous_state], [state],
+                        where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def _set_payment_reconciliations(cls, reconciliations):
+        """
+        Link the reconciliations to the lines for the dictionary of
+        reconciliation id and line id
+        """
+        pool = Pool()
+        Reconciliation = pool.get('account.move.reconciliation')
+        reconciliation = Reconciliation.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_ids in grouped_slice(list(reconciliations)):
+            reconciliation_ids = defaultdict(list)
+            for reconciliation_id in sub_ids:
+                line_id = reconciliations[reconciliation_id]
+                reconciliation_ids[line_id].append(reconciliation_id)
+            cursor.execute(*reconciliation.update(
+                    [reconciliation.bank_statement_move_line],
+                    [Case(*((reduce_ids(reconciliation.id, ids), line_id)
+                                for line_id, ids
+                                in reconciliation_ids.items()))],
+                    where=reduce_ids(reconciliation.id, sub_ids)))
+
+    def _get_payment_transition(self, state):
+        """
+        Return the state to which the payment must change when the line is
+        posted and the payment is in state
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+
+        payment = self.payment
+        payment_amount = Currency.compute(payment.currency,
+            payment.amount, self.line.statement.journal.currency)
+        if payment.kind == 'payable':
+            payment_amount *= -1
+
+        if (payment.journal.clearing_account
+                and payment.journal.clearing_percent < Decimal(1)):
+            advancement_amount = (payment_amount
+                * payment.journal.clearing_percent)
+            pending_amount = (payment_amount
+                * (Decimal(1) - payment.journal.clearing_percent))
+        else:
+            advancement_amount = pending_amount = None
+
+        if (state in ('processing', 'succeeded')
+                and not payment.journal.advance
+                and ((self.amount == -payment_amount)
+                    or (advancement_amount
+                        and self.amount == -advancement_amount))):
+            return 'failed'
+        elif (state in ('processing', 'failed')
+                and ((payment.line
+                        and self.account == payment.line.account
+                        and self.amount == pending_amount)
+                    or (payment.journal.advance
+                        and self.account
+                        != payment.journal.clearing_account
+                        and self.amount == payment_amount))):
+            return 'succeeded'
+
+    def _get_payment_reconciliations(self):
+        "Return the lists of move lines that reconcile the payment"
+        to_reconcile = defaultdict(list)
+        if not self.payment.line:
+            raise UserError(gettext('account_bank_statement_payment.'
+                    'payment_without_account_move',
+                    payment=self.payment.rec_name))
+        lines = self.move.lines + (self.payment.line,)
+        if self.payment.clearing_move:
+            lines += self.payment.clearing_move.lines
+        elif (self.payment.journal.clearing_account
+                and self.payment.journal.advance
+                and self.account == self.payment.journal.clearing_account):
+            for statement_move_line in self.search([
+                        ('payment', '=', self.payment),
+                        ('account', '=', self.account),
+                        ('line.state', '=', 'posted'),
+                        ]):
+                lines += statement_move_line.move.lines
+
+        for line in lines:
+            if line.account.reconcile and not line.reconciliation:
+                key = (
+                    line.account.id,
+                    line.party.id if line.party else None)
+                to_reconcile[key].append(line)
+        return [lines for lines in to_reconcile.values()
+            if not sum((x.debit - x.credit) for x in lines)]
 
     def _check_invoice_amount_to_pay(self):
         if self.payment:
@@ -296,13 +2062,35 @@ class StatementMoveLine(metaclass=PoolMeta):
         else:
             default = default.copy()
         default.setdefault('payment', None)
+        default.setdefault('payment_previous_state', None)
         return super(StatementMoveLine, cls).copy(lines, default=default)
 
 
 class AddPaymentStart(ModelView):
     'Add Payment Start'
     __name__ = 'account.bank.statement.payment.add.start'
-    payments = fields.Many2Many('account.payment', None, None, 'Payments')
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency', readonly=True)
+    amount = Monetary('Pending Amount', currency='currency',
+        digits='currency', readonly=True,
+        help='The amount of the statement lines not yet matched.')
+    date = fields.Date('Date', readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True)
+    statement_lines = fields.Many2Many('account.bank.statement.line',
+        None, None, 'Statement Lines', readonly=True)
+    payments = fields.Many2Many('account.payment', None, None, 'Payments',
+        domain=[
+            ('company', '=', Eval('company', -1)),
+            ('state', 'in', ['processing', 'succeeded', 'failed']),
+            ],
+        search_order=[
+            ('statement_closeness', 'ASC'),
+            ('id', 'DESC'),
+            ],
+        search_context={
+            # Ranked against each statement line
+            'bank_statement_lines': Eval('statement_lines', []),
+            })
 
 
 class AddPayment(Wizard):
@@ -316,6 +2104,37 @@ class AddPayment(Wizard):
             ])
     add = StateTransition()
 
+    def default_start(self, fields):
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+        lines = StatementLine.browse(
+            Transaction().context.get('active_ids', []))
+        if not lines:
+            return {}
+        parties = {getattr(l, 'party', None) for l in lines}
+        party = parties.pop() if len(parties) == 1 else None
+        return {
+            'company': lines[0].company.id,
+            'currency': lines[0].company.currency.id,
+            'amount': sum((l.company_amount - l.moves_amount for l in lines),
+                _ZERO),
+            'date': min(l.date for l in lines).date(),
+            'party': party.id if party else None,
+            'statement_lines': [l.id for l in lines],
+            }
+
+    @staticmethod
+    def _get_payment_account(payment):
+        "Return the account of the statement move line for the payment"
+        if payment.journal.clearing_account:
+            return payment.journal.clearing_account
+        elif payment.line and payment.line.account:
+            return payment.line.account
+        elif payment.kind == 'payable':
+            return payment.party.account_payable
+        elif payment.kind == 'receivable':
+            return payment.party.account_receivable
+
     def transition_add(self):
         pool = Pool()
         StatementLine = pool.get('account.bank.statement.line')
@@ -323,37 +2142,57 @@ class AddPayment(Wizard):
 
         payments = self.start.payments
 
-        to_create = []
+        values, accounts = [], []
         for line in StatementLine.browse(Transaction().context['active_ids']):
             for payment in payments:
-                # TODO move get account to new method
-                if payment.journal.clearing_account:
-                    account = payment.journal.clearing_account
-                elif payment.line and payment.line.account:
-                    account = payment.line.account
-                elif payment.kind == 'payable':
-                    if not payment.party.account_payable:
-                        continue
-                    account = payment.party.account_payable
-                elif payment.kind == 'receivable':
-                    if not payment.party.account_receivable:
-                        continue
-                    account = payment.party.account_receivable
-
-                bsmove_line = BSMoveLine()
-                bsmove_line.line = line
-                bsmove_line.payment = payment
-                bsmove_line.invoice = None
-                bsmove_line.on_change_payment()
-                bsmove_line.date = line.date.date()
-                bsmove_line.amount = bsmove_line.amount or payment.amount
-                bsmove_line.party = bsmove_line.party or payment.party
-                bsmove_line.account = bsmove_line.account or account
-                bsmove_line.description = payment.reference
-                # bsmove_line.move =
-                to_create.append(bsmove_line._save_values())
+                account = self._get_payment_account(payment)
+                if not account:
+                    continue
+                values.append({
+                        'line': line.id,
+                        'payment': payment.id,
+                        })
+                accounts.append(account)
+
+        to_create = []
+        for bsmove_line, account in zip(
+                BSMoveLine._apply_payments(values), accounts):
+            payment = bsmove_line.payment
+            bsmove_line.date = bsmove_line.line.date.date()
+            bsmove_line.amount = bsmove_line.amount or payment.amount
+            bsmove_line.party = bsmove_line.party or payment.party
+            bsmove_line.account = bsmove_line.account or account
+            bsmove_line.description = payment.reference
+            to_create.append(bsmove_line._save_values())
 
         if to_create:
             BSMoveLine.create(to_create)
 
         return 'end'
+
+
+class ImportPaymentReturnStart(ModelView):
+    'Import Payment Returns Start'
+    __name__ = 'account.bank.statement.payment.return.start'
+    file = fields.Binary('File', required=True,
+        help='CSV file with the reference, the amount and the reason of '
+        'each returned payment.')
+
+
+class ImportPaymentReturn(Wizard):
+    'Import Payment Returns'
+    __name__ = 'account.bank.statement.payment.return'
+    start = StateView('account.bank.statement.payment.return.start',
+        'account_bank_statement_payment.'
+        'account_bank_statement_payment_return_start', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+
+    def transition_import_(self):
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+        StatementLine.import_payment_returns(
+            self.record, io.BytesIO(self.start.file))
+        return 'end'
@@ -4,13 +4,48 @@
 
 from decimal import Decimal
 import datetime
+import io
+import json
+import multiprocessing
+import time
+import unittest
+from unittest.mock import patch
+from sql.aggregate import Sum
+from trytond import backend
+from trytond.config import config
 from trytond.pool import Pool
-from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.tests.test_tryton import (ModuleTestCase, with_transaction,
+    DB_NAME)
+from trytond.exceptions import UserError
+from trytond.transaction import Transaction
 
 from trytond.modules.company.tests import create_company, set_company, CompanyTestMixin
+from trytond.modules.currency.tests import create_currency, add_currency_rate
 from trytond.modules.account.tests import create_chart, get_fiscalyear
 from trytond.modules.account_invoice.tests import set_invoice_sequences
 
+from .tools import QueryCounter
+from ..export import COLUMNS, write_links
+from ..tools import clear_cache
+
+_ZERO = Decimal(0)
+
+
+def _claim_payment_group(group_id, payment_ids, barrier, results):
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(DB_NAME)
+    pool.init()
+    with Transaction().start(DB_NAME, 0) as transaction:
+        StatementLine = pool.get('account.bank.statement.line')
+        claimed = StatementLine._claim_payment_group(group_id, payment_ids)
+        # Keep the locks until every process has tried
+        barrier.wait()
+        results.put(claimed)
+        transaction.rollback()
+
 
 class AccountBankStatementPaymentTestCase(CompanyTestMixin, ModuleTestCase):
     'Test AccountBankStatementPayment module'
@@ -172,5 +207,1577 @@ class AccountBankStatementPaymentTestCase(CompanyTestMixin, ModuleTestCase):
             self.assertEqual(list(statement_line.counterpart_lines), [line])
             self.assertEqual(len(statement_line.lines), 1)
 
+    @unittest.skipIf(backend.name != 'postgresql',
+        'requires row-level locks')
+    @with_transaction()
+    def test_payment_group_claim_concurrency(self):
+        'Test only one transaction claims a payment group'
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Company = pool.get('company.company')
+        Party = pool.get('party.party')
+        PaymentJournal = pool.get('account.payment.journal')
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+
+        # The other processes must see the group so it is committed in its
+        # own transaction and deleted at the end
+        with Transaction().new_transaction() as transaction:
+            company = create_company()
+            with transaction.set_context(company=company.id):
+                party, = Party.create([{'name': 'customer'}])
+                payment_journal, = PaymentJournal.create([{
+                            'name': 'Manual',
+                            'process_method': 'manual',
+                            }])
+                group, = Group.create([{
+                            'kind': 'receivable',
+                            'journal': payment_journal.id,
+                            }])
+                payments = Payment.create([{
+                            'journal': payment_journal.id,
+                            'party': party.id,
+                            'kind': 'receivable',
+                            'amount': Decimal('10.0'),
+                            'date': datetime.date.today(),
+                            'group': group.id,
+                            } for _ in range(20)])
+            created = [
+                (Payment, [p.id for p in payments]),
+                (Group, [group.id]),
+                (PaymentJournal, [payment_journal.id]),
+                (Company, [company.id]),
+                (Party, [party.id, company.party.id]),
+                (Currency, [company.currency.id]),
+                ]
+            transaction.commit()
+
+        try:
+            processes = 8
+            ctx = multiprocessing.get_context('spawn')
+            barrier = ctx.Barrier(processes)
+            results = ctx.Queue()
+            workers = [ctx.Process(target=_claim_payment_group,
+                    args=(group.id, [p.id for p in payments], barrier,
+                        results))
+                for _ in range(processes)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join(timeout=60)
+            claimed = [results.get(timeout=1) for _ in range(processes)]
+            self.assertEqual(claimed.count(True), 1)
+        finally:
+            with Transaction().new_transaction() as transaction:
+                for Model, ids in created:
+                    Model.delete(Model.browse(ids))
+                transaction.commit()
+
+    def _prepare_accounting(self, company):
+        "Create the accounting and the journals used by the performance tests"
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        Journal = pool.get('account.journal')
+        Account = pool.get('account.account')
+        Party = pool.get('party.party')
+        PaymentJournal = pool.get('account.payment.journal')
+        StatementJournal = pool.get('account.bank.statement.journal')
+
+        create_chart(company)
+        fiscalyear = set_invoice_sequences(get_fiscalyear(company))
+        fiscalyear.save()
+        FiscalYear.create_period([fiscalyear])
+        receivable, = Account.search([
+                ('type.receivable', '=', True),
+                ('closed', '=', False),
+                ], limit=1)
+        payable, = Account.search([
+                ('type.payable', '=', True),
+                ('closed', '=', False),
+                ], limit=1)
+        revenue, = Account.search([
+                ('type.revenue', '=', True),
+                ('closed', '=', False),
+                ], limit=1)
+        cash, = Account.search([
+                ('code', '=', '1.1.1'),
+                ('closed', '=', False),
+                ], limit=1)
+        cash.bank_reconcile = True
+        cash.save()
+        journal_revenue, = Journal.search([
+                ('code', '=', 'REV'),
+                ])
+        cash_journal, = Journal.copy([journal_revenue], {
+                'type': 'cash',
+                })
+        payment_journal, = PaymentJournal.create([{
+                    'name': 'Manual',
+                    'process_method': 'manual',
+                    }])
+        statement_journal, = StatementJournal.create([{
+                    'name': 'Bank',
+                    'journal': cash_journal.id,
+                    'account': cash.id,
+                    }])
+        party, = Party.create([{
+                    'name': 'customer',
+                    'account_receivable': receivable.id,
+                    'account_payable': payable.id,
+                    }])
+        return {
+            'period': fiscalyear.periods[0],
+            'receivable': receivable,
+            'revenue': revenue,
+            'journal_revenue': journal_revenue,
+            'payment_journal': payment_journal,
+            'statement_journal': statement_journal,
+            'party': party,
+            }
+
+    def _create_line_payments(self, accounting, count):
+        "Create count processing payments with a receivable line each"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Move = pool.get('account.move')
+        Payment = pool.get('account.payment')
+
+        period = accounting['period']
+        lines = [{
+                'party': accounting['party'].id,
+                'account': accounting['receivable'].id,
+                'debit': Decimal(i + 1),
+                'maturity_date': Date.today(),
+                } for i in range(count)]
+        lines.append({
+                'account': accounting['revenue'].id,
+                'credit': sum(l['debit'] for l in lines),
+                })
+        move, = Move.create([{
+                    'period': period.id,
+                    'journal': accounting['journal_revenue'].id,
+                    'date': period.start_date,
+                    'lines': [('create', lines)],
+                    }])
+        Move.post([move])
+        payments = Payment.create([{
+                    'journal': accounting['payment_journal'].id,
+                    'party': accounting['party'].id,
+                    'kind': 'receivable',
+                    'amount': line.debit,
+                    'line': line.id,
+                    'date': Date.today(),
+                    } for line in move.lines if line.debit])
+        Payment.write(payments, {'state': 'processing'})
+        return payments
+
+    def _create_statement(self, accounting, amounts):
+        pool = Pool()
+        Statement = pool.get('account.bank.statement')
+
+        now = datetime.datetime.now()
+        statement, = Statement.create([{
+                    'journal': accounting['statement_journal'].id,
+                    'date': now,
+                    'lines': [('create', [{
+                                    'date': now,
+                                    'description': 'line %s' % i,
+                                    'amount': amount,
+                                    } for i, amount in enumerate(amounts)])],
+                    }])
+        Statement.confirm([statement])
+        return statement
+
+    def _search_reconcile_queries(self, accounting, amounts, extra=0):
+        """
+        Match a statement of amounts with a group each and extra groups of
+        other amounts and count it
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+        StatementLine = pool.get('account.bank.statement.line')
+
+        payment_journal = accounting['payment_journal']
+        group_amounts = amounts + [
+            Decimal(100000 + i) for i in range(extra)]
+        groups = Group.create([{
+                    'kind': 'receivable',
+                    'journal': payment_journal.id,
+                    } for _ in group_amounts])
+        payments = Payment.create([{
+                    'journal': payment_journal.id,
+                    'party': accounting['party'].id,
+                    'kind': 'receivable',
+                    'amount': amount,
+                    'group': group.id,
+                    'date': Date.today(),
+                    } for group, amount in zip(groups, group_amounts)])
+        Payment.write(payments, {'state': 'processing'})
+        statement = self._create_statement(accounting, amounts)
+
+        with QueryCounter() as counter:
+            StatementLine.search_reconcile(statement.lines)
+
+        self.assertTrue(all(l.moves_amount == l.amount
+                for l in StatementLine.browse(
+                    [l.id for l in statement.lines])))
+        return counter
+
+    @with_transaction()
+    def test_search_reconcile_query_count(self):
+        'Test queries of matching a statement among 500 candidate groups'
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            small = self._search_reconcile_queries(
+                accounting, [Decimal(i + 1) for i in range(50)])
+            large = self._search_reconcile_queries(
+                accounting, [Decimal(i + 1001) for i in range(50)],
+                extra=450)
+
+            # The candidates are read in bulk, not one by one
+            self.assertLessEqual(large.queries, small.queries * 2)
+            self.assertLess(large.elapsed, 120)
+
+    def _create_posted_statement_line(
+            self, accounting, payments, with_payment=True):
+        """
+        Create a statement line with a move line per payment, linked to it
+        if with_payment
+        """
+        pool = Pool()
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+
+        statement = self._create_statement(
+            accounting, [sum(p.amount for p in payments)])
+        statement_line, = statement.lines
+        StatementMoveLine.create([{
+                    'line': statement_line.id,
+                    'date': statement_line.date.date(),
+                    'amount': payment.amount,
+                    'party': payment.party.id,
+                    'account': payment.line.account.id,
+                    'payment': payment.id if with_payment else None,
+                    } for payment in payments])
+        return statement_line
+
+    def _post_queries(self, accounting, count, with_payment=True):
+        """
+        Post a statement line with count move lines of payments and count
+        it
+        """
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+
+        payments = self._create_line_payments(accounting, count)
+        statement_line = self._create_posted_statement_line(
+            accounting, payments, with_payment=with_payment)
+
+        with QueryCounter() as counter:
+            StatementLine.post([statement_line])
+
+        if with_payment:
+            self.assertTrue(all(p.line.reconciliation for p in payments))
+        return counter
+
+    @with_transaction()
+    def test_post_statement_line_query_count(self):
+        'Test queries of posting a statement line with 200 payments'
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            small = self._post_queries(accounting, 20)
+            large = self._post_queries(accounting, 200)
+            # The moves are created one by one by the statement
+            small_moves = self._post_queries(
+                accounting, 20, with_payment=False)
+            large_moves = self._post_queries(
+                accounting, 200, with_payment=False)
+
+            # Payments are settled in bulk, not one by one
+            self.assertLessEqual(large.queries - large_moves.queries,
+                (small.queries - small_moves.queries) * 2)
+            self.assertLess(large.elapsed, 120)
+
+    def _cancel_queries(self, accounting, count, with_payment=True):
+        """
+        Cancel a posted statement line with count move lines of payments and
+        count it
+        """
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+        Payment = pool.get('account.payment')
+
+        payments = self._create_line_payments(accounting, count)
+        statement_line = self._create_posted_statement_line(
+            accounting, payments, with_payment=with_payment)
+        StatementLine.post([statement_line])
+
+        with QueryCounter() as counter:
+            StatementLine.cancel([statement_line])
+
+        if with_payment:
+            payments = Payment.browse([p.id for p in payments])
+            self.assertFalse(any(p.line.reconciliation for p in payments))
+            self.assertEqual({p.state for p in payments}, {'processing'})
+            self.assertTrue(
+                all(p.pending_amount == p.amount for p in payments))
+        return counter
+
+    @with_transaction()
+    def test_cancel_statement_line_reverts_posting(self):
+        'Test cancelling a statement line reverts only what its posting made'
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        StatementLine = pool.get('account.bank.statement.line')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        Reconciliation = pool.get('account.move.reconciliation')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = self._create_line_payments(accounting, 2)
+            # Succeeded before the statement
+            Payment.succeed([payments[1]])
+            statement_line = self._create_posted_statement_line(
+                accounting, payments)
+            StatementLine.post([statement_line])
+
+            move_lines = sorted(
+                StatementMoveLine.browse([l.id for l in statement_line.lines]),
+                key=lambda l: l.payment.id)
+            self.assertEqual(
+                [l.payment_previous_state for l in move_lines],
+                ['processing', None])
+            self.assertEqual(
+                {r.bank_statement_move_line for r in Reconciliation.search([
+                            ('lines.move', 'in',
+                                [l.move.id for l in move_lines]),
+                            ])},
+                set(move_lines))
+
+            StatementLine.cancel([statement_line])
+
+            payments = Payment.browse([p.id for p in payments])
+            self.assertEqual(
+                [p.state for p in payments], ['processing', 'succeeded'])
+            self.assertFalse(any(p.line.reconciliation for p in payments))
+            self.assertEqual(
+                [l.payment_previous_state for l in StatementMoveLine.browse(
+                        [l.id for l in move_lines])],
+                [None, None])
+
+    @with_transaction()
+    def test_cancel_statement_line_query_count(self):
+        'Test queries of cancelling a posted statement line with 200 payments'
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            small = self._cancel_queries(accounting, 20)
+            large = self._cancel_queries(accounting, 200)
+            # The moves are cancelled by the statement
+            small_moves = self._cancel_queries(
+                accounting, 20, with_payment=False)
+            large_moves = self._cancel_queries(
+                accounting, 200, with_payment=False)
+
+            # Payments are reverted in bulk, not one by one
+            self.assertLessEqual(large.queries - large_moves.queries,
+                (small.queries - small_moves.queries) * 2)
+
+    def _succeed_queries(self, accounting, count):
+        "Succeed count payments and count it"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Payment = pool.get('account.payment')
+
+        payments = Payment.create([{
+                    'journal': accounting['payment_journal'].id,
+                    'party': accounting['party'].id,
+                    'kind': 'receivable',
+                    'amount': Decimal(i + 1),
+                    'date': Date.today(),
+                    } for i in range(count)])
+        Payment.write(payments, {'state': 'processing'})
+
+        with QueryCounter() as counter:
+            Payment.succeed(payments)
+
+        self.assertTrue(all(p.state == 'succeeded'
+                for p in Payment.browse([p.id for p in payments])))
+        return counter
+
+    @with_transaction()
+    def test_succeed_query_count(self):
+        'Test queries of succeeding 1,000 payments'
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            small = self._succeed_queries(accounting, 100)
+            large = self._succeed_queries(accounting, 1000)
+
+            # Payments are processed in bulk, not one by one
+            self.assertLessEqual(large.queries, small.queries * 2)
+            self.assertLess(large.elapsed, 60)
+
+    @with_transaction()
+    def test_move_line_payment_fields_query_count(self):
+        'Test queries of listing move lines with payment fields'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Line = pool.get('account.move.line')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = self._create_line_payments(accounting, 500)
+            lines = [p.line for p in payments]
+
+            with QueryCounter() as counter:
+                Line.read([l.id for l in lines],
+                    ['payment_group', 'payment_date'])
+                found = Line.search([
+                        ('payment_date', '=', Date.today()),
+                        ])
+
+            self.assertEqual(len(found), len(lines))
+            self.assertLess(counter.queries, 30)
+            self.assertLess(counter.elapsed, 30)
+
+    @with_transaction()
+    def test_statement_move_line_state_query_count(self):
+        'Test queries of reading and searching the state of the line'
+        pool = Pool()
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = self._create_line_payments(accounting, 500)
+            statement = self._create_statement(
+                accounting, [sum(p.amount for p in payments)])
+            statement_line, = statement.lines
+            move_lines = StatementMoveLine.create([{
+                        'line': statement_line.id,
+                        'date': statement_line.date.date(),
+                        'amount': payment.amount,
+                        'party': payment.party.id,
+                        'account': payment.line.account.id,
+                        'payment': payment.id,
+                        } for payment in payments])
+
+            with QueryCounter() as counter:
+                states = StatementMoveLine.read(
+                    [l.id for l in move_lines], ['line_state'])
+                found = StatementMoveLine.search([
+                        ('line_state', '=', 'confirmed'),
+                        ])
+
+            self.assertEqual({s['line_state'] for s in states}, {'confirmed'})
+            self.assertEqual(len(found), len(move_lines))
+            self.assertLess(counter.queries, 30)
+
+    @with_transaction()
+    def test_payment_forecast(self):
+        'Test the forecast follows the processing payments'
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Forecast = pool.get('account.payment.forecast')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = self._create_line_payments(accounting, 10)
+
+            forecasts = Forecast.search([])
+            self.assertEqual(len(forecasts), len(payments))
+            self.assertEqual({f.type for f in forecasts}, {'advanced'})
+            self.assertEqual(sum(f.amount for f in forecasts),
+                sum(p.amount for p in payments))
+
+            Payment.fail(payments[:3])
+            self.assertEqual(Forecast.search_count([]), len(payments) - 3)
+
+            Forecast.rebuild()
+            self.assertEqual(
+                {f.payment for f in Forecast.search([])}, set(payments[3:]))
+
+    @with_transaction()
+    def test_payment_forecast_proposal(self):
+        'Test the proposal of a forecast match has the forecast part'
+        pool = Pool()
+        Account = pool.get('account.account')
+        PaymentJournal = pool.get('account.payment.journal')
+        Forecast = pool.get('account.payment.forecast')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            clearing, = Account.copy([accounting['revenue']], {
+                    'name': 'Clearing',
+                    'reconcile': True,
+                    })
+            PaymentJournal.write([accounting['payment_journal']], {
+                    'clearing_account': clearing.id,
+                    'clearing_percent': Decimal('0.8'),
+                    })
+            payment, = self._create_line_payments(accounting, 1)
+            statement = self._create_statement(
+                accounting, [Decimal('0.80')])
+            statement_line, = statement.lines
+
+            # The advanced part is received on the clearing account
+            proposals = statement_line._get_payment_proposals()
+            self.assertEqual(
+                [(p.payment, p.account, p.amount, p.score)
+                    for p in proposals],
+                [(payment, clearing, Decimal('0.80'), 0.85)])
+
+            # Without party the candidate must be unique
+            self._create_line_payments(accounting, 1)
+            self.assertIsNone(statement_line._match_payments_forecast(
+                    Decimal('0.80'), None))
+
+            # Without clearing account the amount is not split
+            PaymentJournal.write([accounting['payment_journal']], {
+                    'clearing_account': None,
+                    })
+            Forecast.rebuild()
+            self.assertEqual(
+                [(f.type, f.amount) for f in Forecast.search([
+                            ('payment', '=', payment.id),
+                            ])],
+                [('advanced', Decimal(1))])
+
+    @with_transaction()
+    def test_tolerance_matching(self):
+        'Test matching a group with a fee and the sorted totals'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+        StatementLine = pool.get('account.bank.statement.line')
+        group_table = Group.__table__()
+        payment_table = Payment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payment_journal = accounting['payment_journal']
+            payment_journal.statement_tolerance_amount = Decimal('1.00')
+            payment_journal.statement_fee_account = accounting['revenue']
+            payment_journal.save()
+            amounts = [Decimal(i + 1) * 10 for i in range(2000)]
+            groups = Group.create([{
+                        'kind': 'receivable',
+                        'journal': payment_journal.id,
+                        } for _ in amounts])
+            payments = Payment.create([{
+                        'journal': payment_journal.id,
+                        'party': accounting['party'].id,
+                        'kind': 'receivable',
+                        'amount': amount,
+                        'group': group.id,
+                        'date': Date.today(),
+                        } for group, amount in zip(groups, amounts)])
+            Payment.write(payments, {'state': 'processing'})
+            statement = self._create_statement(
+                accounting, [Decimal('99.50')])
+            statement_line, = statement.lines
+
+            # Compare the sorted totals with the SQL range query
+            searches = [a - Decimal('0.50') for a in amounts[::10]]
+            session = StatementLine._get_payment_matching_session()
+            with Transaction().set_context(
+                    _bank_statement_payment_session=session), \
+                    QueryCounter() as counter:
+                found = [statement_line._search_groups_within_tolerance(a)
+                    for a in searches]
+            # The totals are read once for all the searches
+            self.assertLess(counter.queries, 10)
+            expected = []
+            for amount in searches:
+                total = Sum(payment_table.amount)
+                cursor.execute(*group_table.join(payment_table,
+                        condition=payment_table.group == group_table.id
+                        ).select(group_table.id,
+                        where=group_table.company == company.id,
+                        group_by=group_table.id,
+                        having=(total >= amount - 1) & (total <= amount + 1)))
+                expected.append([g for g, in cursor])
+            self.assertEqual(found, expected)
+
+            proposals = statement_line._get_payment_proposals()
+            self.assertEqual(
+                [(p.payment, p.amount) for p in proposals],
+                [(payments[9], Decimal(100)), (None, Decimal('-0.50'))])
+            self.assertEqual(proposals[-1].account, accounting['revenue'])
+
+    @with_transaction()
+    def test_reconcile_payments_watermark(self):
+        'Test matching from the watermark with carry over'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+        StatementLine = pool.get('account.bank.statement.line')
+        Watermark = pool.get('account.bank.statement.payment.watermark')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payment_journal = accounting['payment_journal']
+
+            def create_payments(amounts):
+                groups = Group.create([{
+                            'kind': 'receivable',
+                            'journal': payment_journal.id,
+                            } for _ in amounts])
+                payments = Payment.create([{
+                            'journal': payment_journal.id,
+                            'party': accounting['party'].id,
+                            'kind': 'receivable',
+                            'amount': amount,
+                            'group': group.id,
+                            'date': Date.today(),
+                            } for group, amount in zip(groups, amounts)])
+                Payment.write(payments, {'state': 'processing'})
+
+            def matched(statement):
+                return [l.moves_amount == l.amount
+                    for l in StatementLine.browse(
+                        [l.id for l in statement.lines])]
+
+            amounts = [Decimal(i + 1) for i in range(5)]
+            create_payments(amounts)
+            statement = self._create_statement(accounting, amounts)
+            self.assertTrue(StatementLine._reconcile_payments_company(
+                    company.id, time.monotonic() + 60))
+            self.assertTrue(all(matched(statement)))
+            mark, = Watermark.search([('company', '=', company.id)])
+            self.assertTrue(mark.watermark)
+            self.assertIsNone(mark.run_start)
+
+            # The run stops at the time limit and continues on the next one
+            amounts = [Decimal(i + 10) for i in range(5)]
+            create_payments(amounts)
+            statement = self._create_statement(accounting, amounts)
+            self.assertFalse(StatementLine._reconcile_payments_company(
+                    company.id, time.monotonic() - 1))
+            self.assertFalse(any(matched(statement)))
+            mark, = Watermark.search([('company', '=', company.id)])
+            self.assertTrue(mark.run_start)
+            self.assertTrue(StatementLine._reconcile_payments_company(
+                    company.id, time.monotonic() + 60))
+            self.assertTrue(all(matched(statement)))
+
+            # Only the unmatched lines of the kind of the changed payments
+            statement = self._create_statement(
+                accounting, [Decimal(100), Decimal(-100)])
+            create_payments([Decimal(200)])
+            self.assertEqual(
+                StatementLine.search([
+                        ('statement', '=', statement.id),
+                        StatementLine._get_unmatched_lines_domain(
+                            company.id, datetime.datetime.min),
+                        ]),
+                [l for l in statement.lines if l.amount > 0])
+
+    @with_transaction()
+    def test_reconcile_payments_companies(self):
+        'Test the failure of a company does not stop the others'
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+
+        company = create_company()
+        other = create_company(name='Other', currency=company.currency)
+        calls = []
+
+        def reconcile(company_id, deadline):
+            calls.append(company_id)
+            if len(calls) == 1:
+                raise ValueError
+
+        with patch.object(StatementLine, '_reconcile_payments_company',
+                side_effect=reconcile), \
+                self.assertLogs(
+                    'trytond.modules.account_bank_statement_payment',
+                    'ERROR'):
+            StatementLine.cron_reconcile_payments()
+        self.assertEqual(sorted(calls), sorted([company.id, other.id]))
+
+    @with_transaction()
+    def test_payment_prediction(self):
+        'Test matching the recurring payments of a party'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Payment = pool.get('account.payment')
+        StatementLine = pool.get('account.bank.statement.line')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        Prediction = pool.get('account.payment.prediction')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payment, = self._create_line_payments(accounting, 1)
+            statement = self._create_statement(accounting, [payment.amount])
+            statement_line, = statement.lines
+            StatementMoveLine.create([{
+                        'line': statement_line.id,
+                        'date': statement_line.date.date(),
+                        'amount': payment.amount,
+                        'party': payment.party.id,
+                        'account': payment.line.account.id,
+                        'payment': payment.id,
+                        }])
+            StatementLine.post([statement_line])
+            posted_line = statement_line
+
+            prediction, = Prediction.search([])
+            self.assertEqual(prediction.party, payment.party)
+            self.assertEqual(prediction.amount, payment.amount)
+            self.assertEqual(prediction.count, 1)
+
+            new_payment, = self._create_line_payments(accounting, 1)
+            statement = self._create_statement(accounting, [payment.amount])
+            statement_line, = statement.lines
+            with QueryCounter() as counter:
+                match = statement_line._match_payments_prediction(
+                    payment.amount, time.monotonic() + 60)
+            # Only proposed as the line has no party
+            self.assertEqual(match, ([new_payment], 0.75))
+            self.assertLess(counter.queries, 10)
+
+            if 'party' in StatementLine._fields:
+                # The single candidate of the party is confident
+                statement_line.party = payment.party
+                self.assertEqual(
+                    statement_line._match_payments_prediction(
+                        payment.amount, time.monotonic() + 60),
+                    ([new_payment], 0.85))
+                statement_line = StatementLine(statement_line.id)
+
+            # Without party, the candidates of other parties are ambiguous
+            other, = Party.create([{
+                        'name': 'other',
+                        'account_receivable': accounting['receivable'].id,
+                        }])
+            Prediction.create([{
+                        'company': company.id,
+                        'party': other.id,
+                        'journal': prediction.journal.id,
+                        'kind': prediction.kind,
+                        'currency': prediction.currency.id,
+                        'amount': prediction.amount,
+                        'last_date': prediction.last_date,
+                        'count': 1,
+                        }])
+            other_payment, = Payment.create([{
+                        'journal': accounting['payment_journal'].id,
+                        'party': other.id,
+                        'kind': 'receivable',
+                        'amount': payment.amount,
+                        'date': new_payment.date,
+                        }])
+            Payment.write([other_payment], {'state': 'processing'})
+            self.assertIsNone(statement_line._match_payments_prediction(
+                    payment.amount, time.monotonic() + 60))
+
+            Prediction.rebuild()
+            prediction, = Prediction.search([])
+            self.assertEqual(prediction.count, 1)
+
+            # Cancelling removes the history of the posting
+            StatementLine.cancel([posted_line])
+            self.assertEqual(Prediction.search([]), [])
+
+    def _import_returns_queries(self, accounting, count):
+        "Import the returns of count payments and count it"
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        StatementLine = pool.get('account.bank.statement.line')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+
+        payments = self._create_line_payments(accounting, count)
+        for payment in payments:
+            payment.reference = 'R%s' % payment.id
+        Payment.save(payments)
+        statement = self._create_statement(
+            accounting, [-sum(p.amount for p in payments)])
+        statement_line, = statement.lines
+        data = 'reference;amount;reason\n' + ''.join(
+            '%s;%s;AC04\n' % (p.reference, p.amount) for p in payments)
+
+        with QueryCounter() as counter:
+            result = StatementLine.import_payment_returns(
+                statement_line, io.BytesIO(data.encode('utf-8')))
+
+        self.assertEqual(result, len(payments))
+        self.assertEqual({p.state for p in Payment.browse(
+                        [p.id for p in payments])}, {'failed'})
+        move_lines = StatementMoveLine.search([
+                ('line', '=', statement_line.id),
+                ])
+        self.assertEqual(sum(l.amount for l in move_lines),
+            statement_line.amount)
+        self.assertEqual({l.description for l in move_lines}, {'AC04'})
+        self.assertEqual(
+            {l.payment_previous_state for l in move_lines}, {'processing'})
+        return counter
+
+    @with_transaction()
+    def test_import_payment_returns(self):
+        'Test importing the returns of 1,000 payments'
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        StatementLine = pool.get('account.bank.statement.line')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            small = self._import_returns_queries(accounting, 100)
+            large = self._import_returns_queries(accounting, 1000)
+
+            # The returns are processed by batches
+            self.assertLessEqual(large.queries, small.queries * 2)
+
+            # Nothing is changed if a reference is unknown
+            payment, = self._create_line_payments(accounting, 1)
+            payment.reference = 'KNOWN'
+            payment.save()
+            statement = self._create_statement(accounting, [-payment.amount])
+            statement_line, = statement.lines
+            with self.assertRaises(UserError):
+                StatementLine.import_payment_returns(
+                    statement_line, io.BytesIO(b'KNOWN;1\nUNKNOWN;1\n'))
+            self.assertEqual(Payment(payment.id).state, 'processing')
+            self.assertFalse(StatementMoveLine.search([
+                        ('line', '=', statement_line.id),
+                        ]))
+
+            # Only the first row can be a header
+            with self.assertRaises(UserError):
+                StatementLine.import_payment_returns(
+                    statement_line, io.BytesIO(b'KNOWN;1\nKNOWN;one\n'))
+            self.assertEqual(Payment(payment.id).state, 'processing')
+
+    @with_transaction()
+    def test_export_links_throughput(self):
+        'Test exporting the links of 1,000 payments by batches'
+        pool = Pool()
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = self._create_line_payments(accounting, 1000)
+            statement = self._create_statement(
+                accounting, [sum(p.amount for p in payments)])
+            statement_line, = statement.lines
+            StatementMoveLine.create([{
+                        'line': statement_line.id,
+                        'date': statement_line.date.date(),
+                        'amount': payment.amount,
+                        'party': payment.party.id,
+                        'account': payment.line.account.id,
+                        'payment': payment.id,
+                        } for payment in payments])
+            fiscalyear = accounting['period'].fiscalyear
+
+            for format in ['csv', 'jsonl']:
+                output = io.StringIO()
+                with QueryCounter() as counter:
+                    count = write_links(
+                        fiscalyear, output, format=format, size=100)
+
+                self.assertEqual(count, len(payments))
+                self.assertEqual(
+                    len(output.getvalue().splitlines()),
+                    count + (format == 'csv'))
+                # One query by batch of each kind of link
+                self.assertLessEqual(counter.queries, count // 100 + 2)
+
+            output = io.StringIO()
+            write_links(fiscalyear, output, format='jsonl')
+            link = json.loads(output.getvalue().splitlines()[0])
+            self.assertEqual(list(link), COLUMNS)
+            self.assertEqual(link['statement_line'], statement_line.id)
+
+    @with_transaction()
+    def test_scale_clearing_move(self):
+        'Test scaling a clearing move keeps it balanced'
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        PaymentJournal = pool.get('account.payment.journal')
+        Move = pool.get('account.move')
+        Line = pool.get('account.move.line')
+
+        company = create_company()
+        with set_company(company):
+            journal = PaymentJournal(
+                clearing_percent=Decimal('0.5'), currency=company.currency)
+            payment = Payment(journal=journal, company=company)
+            move = Move(lines=[
+                    Line(debit=Decimal('1.01'), credit=_ZERO),
+                    Line(debit=Decimal('1.01'), credit=_ZERO),
+                    Line(debit=Decimal('1.01'), credit=_ZERO),
+                    Line(debit=_ZERO, credit=Decimal('3.03')),
+                    ])
+
+            payment._scale_clearing_move(move)
+
+            self.assertEqual(sum(l.debit for l in move.lines),
+                sum(l.credit for l in move.lines))
+            for line, amount in zip(move.lines, ['0.505'] * 3 + ['1.515']):
+                self.assertLessEqual(
+                    abs(line.debit + line.credit - Decimal(amount)),
+                    Decimal('0.02'))
+
+    @with_transaction()
+    def test_transition_from_statement_resume(self):
+        'Test running the statement transitions again skips the done ones'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Payment = pool.get('account.payment')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = Payment.create([{
+                        'journal': accounting['payment_journal'].id,
+                        'party': accounting['party'].id,
+                        'kind': 'receivable',
+                        'amount': Decimal(i + 1),
+                        'date': Date.today(),
+                        } for i in range(10)])
+            Payment.write(payments, {'state': 'processing'})
+            # A previous run stopped after the first payments
+            Payment.succeed(payments[:5])
+
+            Payment.transition_from_statement({'succeeded': payments})
+            self.assertEqual({p.state for p in Payment.browse(
+                            [p.id for p in payments])}, {'succeeded'})
+
+            with QueryCounter() as counter:
+                Payment.transition_from_statement({'succeeded': payments})
+            # Only the states are read
+            self.assertLess(counter.queries, 5)
+
+    @with_transaction()
+    def test_accept_payment_proposals(self):
+        'Test accepting payment proposals checks them against the payment'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+        StatementLine = pool.get('account.bank.statement.line')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payment_journal = accounting['payment_journal']
+            group, = Group.create([{
+                        'kind': 'receivable',
+                        'journal': payment_journal.id,
+                        }])
+            payment, = Payment.create([{
+                        'journal': payment_journal.id,
+                        'party': accounting['party'].id,
+                        'kind': 'receivable',
+                        'amount': Decimal(50),
+                        'group': group.id,
+                        'date': Date.today(),
+                        }])
+            Payment.write([payment], {'state': 'processing'})
+            statement = self._create_statement(accounting, [Decimal(50)])
+            statement_line, = statement.lines
+
+            proposal, = StatementLine.get_payment_proposals([statement_line])
+            self.assertEqual(proposal['payment'], payment.id)
+            self.assertEqual(proposal['amount'], Decimal(50))
+
+            for tampered in [
+                    {'amount': Decimal(500)},
+                    {'account': accounting['revenue'].id},
+                    {'payment': None},
+                    ]:
+                with self.assertRaises(UserError):
+                    StatementLine.accept_payment_proposals(
+                        [dict(proposal, **tampered)])
+
+            StatementLine.accept_payment_proposals([proposal])
+            statement_line = StatementLine(statement_line.id)
+            self.assertEqual(statement_line.moves_amount, Decimal(50))
+
+    @with_transaction()
+    def test_payment_candidates(self):
+        'Test matching runs on candidate rows and skips reconciled groups'
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payment_journal = accounting['payment_journal']
+            payments = self._create_line_payments(accounting, 2)
+            groups = Group.create([{
+                        'kind': 'receivable',
+                        'journal': payment_journal.id,
+                        } for _ in payments])
+            for payment, group in zip(payments, groups):
+                Payment.write([payment], {'group': group.id})
+            statement = self._create_statement(accounting, [Decimal(1)])
+            statement_line, = statement.lines
+
+            candidates = statement_line._get_payment_candidates(Decimal(1))
+            self.assertEqual(candidates, [(groups[0].id, payments[0].id,
+                        Decimal(1), 'processing', payments[0].line.id, None,
+                        accounting['party'].id, payment_journal.id)])
+
+            # The group with a reconciled payment line is skipped
+            row = list(candidates[0])
+            row[5] = 1
+            candidates = [tuple(row), (groups[1].id, payments[1].id,
+                    Decimal(2), 'processing', payments[1].line.id, None,
+                    accounting['party'].id, payment_journal.id)]
+            self.assertEqual(
+                statement_line._select_candidate_payments(candidates),
+                [payments[1]])
+
+    @with_transaction()
+    def test_payment_unmatched(self):
+        'Test the unmatched payments report and its filters'
+        pool = Pool()
+        Unmatched = pool.get('account.payment.unmatched')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = self._create_line_payments(accounting, 3)
+
+            unmatched = Unmatched.search([])
+            self.assertEqual({u.payment for u in unmatched}, set(payments))
+            # No clearing account, so nothing is advanced
+            self.assertEqual({u.advanced_amount for u in unmatched}, {_ZERO})
+            self.assertTrue(
+                all(u.pending_amount == u.amount for u in unmatched))
+
+            for context, count in [
+                    ({'kind': 'payable'}, 0),
+                    ({'kind': 'receivable'}, 3),
+                    ({'party': accounting['party'].id}, 3),
+                    ({'journal': accounting['payment_journal'].id}, 3),
+                    ]:
+                with Transaction().set_context(context):
+                    self.assertEqual(Unmatched.search_count([]), count)
+
+    @with_transaction()
+    def test_converted_group_matching(self):
+        'Test matching a group of another currency at its converted total'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Payment = pool.get('account.payment')
+        PaymentJournal = pool.get('account.payment.journal')
+        Group = pool.get('account.payment.group')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            currency = create_currency('cur')
+            add_currency_rate(currency, Decimal(2))
+            payment_journal, = PaymentJournal.create([{
+                        'name': 'Foreign',
+                        'process_method': 'manual',
+                        'currency': currency.id,
+                        'statement_cross_currency': True,
+                        'statement_currency_tolerance': Decimal('0.01'),
+                        'statement_tolerance_amount': Decimal(1),
+                        'statement_fee_account': accounting['revenue'].id,
+                        }])
+            group, = Group.create([{
+                        'kind': 'receivable',
+                        'journal': payment_journal.id,
+                        }])
+            payments = Payment.create([{
+                        'journal': payment_journal.id,
+                        'party': accounting['party'].id,
+                        'kind': 'receivable',
+                        'amount': amount,
+                        'group': group.id,
+                        'date': Date.today(),
+                        } for amount in [Decimal(60), Decimal('40.02')]])
+            Payment.write(payments, {'state': 'processing'})
+            statement = self._create_statement(accounting, [Decimal(50)])
+            statement_line, = statement.lines
+
+            # 100.02 cur is 50.01 in the company currency
+            self.assertEqual(
+                statement_line._search_converted_groups(Decimal(50)),
+                [group.id])
+            self.assertEqual(
+                statement_line._search_converted_groups(Decimal(49)), [])
+            self.assertEqual(
+                statement_line._match_payments_converted_group(
+                    Decimal(50), None),
+                (payments, 0.9))
+
+            # The conversion difference is not a fee but goes to the last
+            # payment
+            proposals = statement_line._get_payment_proposals()
+            self.assertEqual(
+                [(p.payment, p.amount) for p in proposals],
+                [(payments[0], Decimal(30)), (payments[1], Decimal(20))])
+
+    @with_transaction()
+    def test_search_reconcile_fingerprint(self):
+        'Test lines are skipped until they or their candidates change'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+        StatementLine = pool.get('account.bank.statement.line')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payment_journal = accounting['payment_journal']
+            group, = Group.create([{
+                        'kind': 'receivable',
+                        'journal': payment_journal.id,
+                        }])
+            payment, = Payment.create([{
+                        'journal': payment_journal.id,
+                        'party': accounting['party'].id,
+                        'kind': 'receivable',
+                        'amount': Decimal(50),
+                        'group': group.id,
+                        'date': Date.today(),
+                        }])
+            statement = self._create_statement(accounting, [Decimal(50)])
+            statement_line, = statement.lines
+
+            # Without candidate the line is fingerprinted and skipped
+            StatementLine.search_reconcile([statement_line])
+            statement_line = StatementLine(statement_line.id)
+            self.assertFalse(statement_line.lines)
+            fingerprint = statement_line.payment_match_fingerprint
+            self.assertTrue(fingerprint)
+            with QueryCounter() as counter:
+                StatementLine.search_reconcile([statement_line])
+            self.assertLess(counter.queries, 10)
+
+            # A change of the candidates matches it again
+            Payment.write([payment], {'state': 'processing'})
+            StatementLine.search_reconcile([statement_line])
+            statement_line = StatementLine(statement_line.id)
+            self.assertEqual(statement_line.moves_amount, Decimal(50))
+            self.assertNotEqual(
+                statement_line.payment_match_fingerprint, fingerprint)
+
+            with QueryCounter() as counter:
+                StatementLine.search_reconcile([statement_line])
+            self.assertEqual(len(statement_line.lines), 1)
+            # Only the fingerprint is computed
+            self.assertLess(counter.queries, 10)
+
+            # Removing the moves changes the fingerprint
+            StatementMoveLine.delete(list(statement_line.lines))
+            statement_line = StatementLine(statement_line.id)
+            StatementLine.search_reconcile([statement_line])
+            statement_line = StatementLine(statement_line.id)
+            self.assertEqual(statement_line.moves_amount, Decimal(50))
+
+            # The fingerprint is stored without changing the write date
+            fingerprint = statement_line.payment_match_fingerprint
+            StatementLine._set_payment_match_fingerprints(
+                {None: [statement_line]})
+            write_date = statement_line.write_date
+            StatementLine.search_reconcile([statement_line])
+            statement_line = StatementLine(statement_line.id)
+            self.assertEqual(
+                statement_line.payment_match_fingerprint, fingerprint)
+            self.assertEqual(statement_line.write_date, write_date)
+
+    @with_transaction()
+    def test_statement_closeness(self):
+        'Test payments are ranked against each selected statement line'
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        table = Payment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = self._create_line_payments(accounting, 3)
+            statement = self._create_statement(
+                accounting, [Decimal(1), Decimal(3)])
+
+            with Transaction().set_context(
+                    bank_statement_lines=[l.id for l in statement.lines]):
+                found = Payment.search([
+                        ('id', 'in', [p.id for p in payments]),
+                        ], order=[
+                        ('statement_closeness', 'ASC'),
+                        ('id', 'ASC'),
+                        ])
+                self.assertEqual(found,
+                    [payments[0], payments[2], payments[1]])
+                self.assertEqual(
+                    [p.statement_closeness for p in found],
+                    [_ZERO, _ZERO, Decimal(1)])
+
+            # The pending amount is ranked
+            cursor.execute(*table.update(
+                    [table.pending_amount], [Decimal(2)],
+                    where=table.id == payments[2].id))
+            clear_cache(payments[2:])
+            with Transaction().set_context(
+                    bank_statement_lines=[l.id for l in statement.lines]):
+                found = Payment.search([
+                        ('id', 'in', [p.id for p in payments]),
+                        ], order=[
+                        ('statement_closeness', 'ASC'),
+                        ('id', 'ASC'),
+                        ])
+                self.assertEqual(found, payments)
+                self.assertEqual(
+                    [p.statement_closeness for p in found],
+                    [_ZERO, Decimal(1), Decimal(1)])
+
+    @with_transaction()
+    def test_get_payment_values(self):
+        'Test computing the payment values of many move lines at once'
+        pool = Pool()
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = self._create_line_payments(accounting, 20)
+            statement = self._create_statement(
+                accounting, [sum(p.amount for p in payments)])
+            statement_line, = statement.lines
+
+            with QueryCounter() as counter:
+                values = StatementMoveLine.get_payment_values([{
+                            'line': statement_line.id,
+                            'payment': p.id,
+                            } for p in payments])
+
+            self.assertEqual(values, [{
+                        'party': accounting['party'].id,
+                        'account': None,
+                        'invoice': None,
+                        'amount': p.amount,
+                        } for p in payments])
+            self.assertLess(counter.queries, 30)
+
+    @with_transaction()
+    def test_payment_window(self):
+        'Test groups with a payment outside the window are not matched'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payment_journal = accounting['payment_journal']
+            payment_journal.statement_window = 5
+            payment_journal.save()
+            today = Date.today()
+            groups = Group.create([{
+                        'kind': 'receivable',
+                        'journal': payment_journal.id,
+                        } for _ in range(2)])
+            payments = Payment.create([{
+                        'journal': payment_journal.id,
+                        'party': accounting['party'].id,
+                        'kind': 'receivable',
+                        'amount': Decimal(10),
+                        'group': group.id,
+                        'date': date,
+                        } for group, date in [
+                        (groups[0], today),
+                        (groups[0], today - datetime.timedelta(days=30)),
+                        (groups[1], today),
+                        (groups[1], today - datetime.timedelta(days=2)),
+                        ]])
+            Payment.write(payments, {'state': 'processing'})
+            statement = self._create_statement(accounting, [Decimal(20)])
+            statement_line, = statement.lines
+
+            candidates = statement_line._get_payment_candidates(Decimal(20))
+            self.assertEqual({c[0] for c in candidates}, {groups[1].id})
+            # Only the payments within the window would total 10
+            self.assertEqual(
+                statement_line._get_payment_candidates(Decimal(10)), [])
+
+    @with_transaction()
+    def test_group_settled(self):
+        'Test the settled flag follows the reconciliation of the payments'
+        pool = Pool()
+        Move = pool.get('account.move')
+        Line = pool.get('account.move.line')
+        Reconciliation = pool.get('account.move.reconciliation')
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = self._create_line_payments(accounting, 2)
+            group, = Group.create([{
+                        'kind': 'receivable',
+                        'journal': accounting['payment_journal'].id,
+                        }])
+            Payment.write(payments, {'group': group.id})
+            period = accounting['period']
+            lines = [{
+                    'party': accounting['party'].id,
+                    'account': accounting['receivable'].id,
+                    'credit': p.amount,
+                    } for p in payments]
+            lines.append({
+                    'account': accounting['revenue'].id,
+                    'debit': sum(l['credit'] for l in lines),
+                    })
+            move, = Move.create([{
+                        'period': period.id,
+                        'journal': accounting['journal_revenue'].id,
+                        'date': period.start_date,
+                        'lines': [('create', lines)],
+                        }])
+            Move.post([move])
+            credits = {l.credit: l for l in move.lines if l.credit}
+            statement = self._create_statement(accounting, [Decimal(3)])
+            statement_line, = statement.lines
+
+            def settled():
+                return Group(group.id).settled
+
+            Line.reconcile([payments[0].line, credits[payments[0].amount]])
+            self.assertFalse(settled())
+            Line.reconcile([payments[1].line, credits[payments[1].amount]])
+            self.assertTrue(settled())
+            self.assertEqual(
+                statement_line._get_payment_candidates(Decimal(3)), [])
+
+            Reconciliation.delete([Line(payments[1].line.id).reconciliation])
+            self.assertFalse(settled())
+            self.assertEqual(
+                {c[0] for c in statement_line._get_payment_candidates(
+                        Decimal(3))}, {group.id})
+
+    @with_transaction()
+    def test_payment_counterparts(self):
+        'Test payment lines already counterparted are not proposed again'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Payment = pool.get('account.payment')
+        Group = pool.get('account.payment.group')
+        StatementLine = pool.get('account.bank.statement.line')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = self._create_line_payments(accounting, 2)
+            group, = Group.create([{
+                        'kind': 'receivable',
+                        'journal': accounting['payment_journal'].id,
+                        }])
+            Payment.write(payments, {'group': group.id})
+            statement = self._create_statement(
+                accounting, [Decimal(3), Decimal(1)])
+            statement_line, other_line = statement.lines
+            Line.write([payments[0].line], {
+                    'bank_statement_line_counterpart': other_line.id,
+                    })
+
+            proposals = statement_line._get_payment_proposals()
+            self.assertEqual(
+                [(p.payment, p.counterpart) for p in proposals],
+                [(payments[1], payments[1].line)])
+
+            StatementLine.search_reconcile([statement_line])
+            self.assertEqual(
+                Line(payments[0].line.id).bank_statement_line_counterpart,
+                other_line)
+            self.assertEqual(
+                Line(payments[1].line.id).bank_statement_line_counterpart,
+                statement_line)
+
+    def _match_payments_calls(self, statement_line, matches, claim=False):
+        """
+        Run _match_payments of statement_line with the strategies returning
+        matches and return the result, the strategies called and the session
+        """
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+
+        session = StatementLine._get_payment_matching_session()
+        calls = []
+
+        def strategy(name):
+            def match(amount, deadline):
+                calls.append(name)
+                return matches.get(name)
+            return match
+
+        with Transaction().set_context(
+                _bank_statement_payment_session=session):
+            strategies = [patch.object(StatementLine,
+                    '_match_payments_%s' % name, strategy(name))
+                for _, name in StatementLine._payment_matching_strategies()]
+            for strategy_patch in strategies:
+                strategy_patch.start()
+            try:
+                result = statement_line._match_payments(
+                    statement_line.amount, claim=claim)
+            finally:
+                for strategy_patch in strategies:
+                    strategy_patch.stop()
+        return result, calls, session
+
+    @with_transaction()
+    def test_match_payments_pipeline(self):
+        'Test the order, the claims and the time budget of the matching'
+        pool = Pool()
+        StatementLine = pool.get('account.bank.statement.line')
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payments = self._create_line_payments(accounting, 2)
+            statement = self._create_statement(accounting, [Decimal(2)])
+            statement_line, = statement.lines
+
+            # The cheapest strategies run first until one is confident
+            result, calls, session = self._match_payments_calls(
+                statement_line, {
+                    'prediction': ([payments[0]], 0.5),
+                    'exact_group': ([payments[1]], 1.0),
+                    'forecast': ([payments[0]], 0.85),
+                    })
+            self.assertEqual(result, ([payments[1]], 1.0))
+            self.assertEqual(calls, ['prediction', 'exact_group'])
+            self.assertEqual(session.claimed_payments, {payments[1].id})
+
+            # Only the winner is claimed
+            with patch.object(StatementLine, '_claim_payment_match',
+                    return_value=True) as claim:
+                result, calls, session = self._match_payments_calls(
+                    statement_line, {
+                        'prediction': ([payments[0]], 0.5),
+                        'exact_group': ([payments[1]], 1.0),
+                        }, claim=True)
+            claim.assert_called_once_with([payments[1]])
+
+            # A match held by another transaction is released and skipped
+            with patch.object(StatementLine, '_claim_payment_match',
+                    side_effect=[False, True]):
+                result, calls, session = self._match_payments_calls(
+                    statement_line, {
+                        'exact_group': ([payments[1]], 1.0),
+                        }, claim=True)
+            self.assertEqual(calls.count('exact_group'), 2)
+            self.assertIn(payments[1].id, session.claimed_payments)
+
+            # A match below the confidence is only proposed
+            with patch.object(StatementLine, '_claim_payment_match') as claim:
+                result, calls, session = self._match_payments_calls(
+                    statement_line, {
+                        'subset': ([payments[0], payments[1]], 0.6),
+                        }, claim=True)
+            self.assertEqual(result, ([payments[0], payments[1]], 0.6))
+            claim.assert_not_called()
+            self.assertFalse(session.claimed_payments)
+
+            # Out of time only the exact group match runs
+            section = 'account_bank_statement_payment'
+            if not config.has_section(section):
+                config.add_section(section)
+            config.set(section, 'line_time_budget', '-1')
+            try:
+                result, calls, session = self._match_payments_calls(
+                    statement_line, {
+                        'prediction': ([payments[0]], 0.9),
+                        'exact_group': ([payments[1]], 1.0),
+                        })
+            finally:
+                config.remove_option(section, 'line_time_budget')
+            self.assertEqual(result, ([payments[1]], 1.0))
+            self.assertEqual(calls, ['exact_group'])
+
+    @with_transaction()
+    def test_pending_amount(self):
+        'Test the pending amount of returned and converted payments'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Payment = pool.get('account.payment')
+        PaymentJournal = pool.get('account.payment.journal')
+        StatementLine = pool.get('account.bank.statement.line')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+        table = StatementLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            accounting = self._prepare_accounting(company)
+            payment, = self._create_line_payments(accounting, 1)
+            eur = create_currency('eur')
+            add_currency_rate(eur, Decimal(2))
+            eur_journal, = PaymentJournal.create([{
+                        'name': 'Manual EUR',
+                        'process_method': 'manual',
+                        'currency': eur.id,
+                        }])
+            eur_payment, = Payment.create([{
+                        'journal': eur_journal.id,
+                        'party': accounting['party'].id,
+                        'kind': 'receivable',
+                        'amount': Decimal(100),
+                        'date': Date.today(),
+                        }])
+            statement = self._create_statement(
+                accounting, [-payment.amount, Decimal(30)])
+            return_line, eur_line = statement.lines
+            StatementMoveLine.create([{
+                        'line': return_line.id,
+                        'date': return_line.date.date(),
+                        'amount': -payment.amount,
+                        'party': payment.party.id,
+                        'account': payment.line.account.id,
+                        'payment': payment.id,
+                        }, {
+                        'line': eur_line.id,
+                        'date': eur_line.date.date(),
+                        'amount': Decimal(30),
+                        'party': eur_payment.party.id,
+                        'account': accounting['receivable'].id,
+                        'payment': eur_payment.id,
+                        }])
+            cursor.execute(*table.update([table.state], ['posted'],
+                    where=table.id.in_([return_line.id, eur_line.id])))
+            write_dates = [payment.write_date, eur_payment.write_date]
+
+            Payment.update_pending_amount([payment, eur_payment])
+
+            # A return restores the pending amount without doubling it
+            self.assertEqual(payment.pending_amount, payment.amount)
+            # The statement amount is converted to the payment currency
+            self.assertEqual(eur_payment.pending_amount, Decimal(40))
+            # The cache is cleared without writing the payments
+            self.assertEqual(
+                [payment.write_date, eur_payment.write_date], write_dates)
+
 
 del ModuleTestCase
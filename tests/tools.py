@@ -0,0 +1,39 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import time
+
+from trytond.transaction import Transaction
+
+from ..replay import _RecordingConnection
+
+__all__ = ['QueryCounter']
+
+
+class QueryCounter(object):
+    """
+    Count the SQL statements executed and the time elapsed inside the block
+
+        with QueryCounter() as counter:
+            ...
+        counter.queries, counter.elapsed
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.elapsed = 0.
+
+    def __enter__(self):
+        transaction = Transaction()
+        self._transaction = transaction
+        self._connection = transaction.connection
+        transaction.connection = _RecordingConnection(
+            self._connection, self._record)
+        self._start = time.perf_counter()
+        return self
+
+    def _record(self, duration, query):
+        self.queries += 1
+
+    def __exit__(self, type, value, traceback):
+        self.elapsed = time.perf_counter() - self._start
+        self._transaction.connection = self._connection
@@ -0,0 +1,25 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.transaction import Transaction
+
+__all__ = ['clear_cache']
+
+
+def clear_cache(records):
+    """
+    Clear the cache of the records of a model updated through SQL
+
+    The records are not written so their write_date is kept.
+    """
+    if not records:
+        return
+    transaction = Transaction()
+    name = records[0].__name__
+    transaction.counter += 1
+    for record in records:
+        record._local_cache.pop(record.id, None)
+    for cache in transaction.cache.values():
+        if name in cache:
+            cache_model = cache[name]
+            for record in records:
+                cache_model.pop(record.id, None)